@@ -0,0 +1,180 @@
+import numpy as np
+from PIL.Image import Image
+from . import etc1
+from .etc1 import ETC1Quality
+from .swizzler import luminance
+from .txob import TextureFormat
+
+# formats considered for automatic selection
+# RGBA8 is left out as it doesn't work in the home menu
+COLOR_CANDIDATES = [
+    TextureFormat.A4,
+    TextureFormat.L4,
+    TextureFormat.ETC1,
+    TextureFormat.A8,
+    TextureFormat.L8,
+    TextureFormat.LA4,
+    TextureFormat.ETC1A4,
+    TextureFormat.LA8,
+    TextureFormat.RGB565,
+    TextureFormat.RGBA5551,
+    TextureFormat.RGBA4,
+    TextureFormat.RGB8,
+]
+NORMAL_CANDIDATES = [
+    TextureFormat.ETC1,
+    TextureFormat.HILO8,
+    TextureFormat.RGB565,
+    TextureFormat.RGB8,
+]
+ALPHA_FORMATS = {
+    TextureFormat.RGBA8,
+    TextureFormat.RGBA5551,
+    TextureFormat.RGBA4,
+    TextureFormat.LA8,
+    TextureFormat.A8,
+    TextureFormat.LA4,
+    TextureFormat.A4,
+    TextureFormat.ETC1A4,
+}
+
+
+class TextureStats:
+    opaque: bool
+    # every pixel is either fully transparent or fully opaque
+    binary_alpha: bool
+    grayscale: bool
+    # largest difference between the channels of a pixel
+    chroma_range: int
+
+    def __init__(self, pixels: np.ndarray):
+        """pixels is (height, width, 4)"""
+        pixels = pixels.reshape(-1, 4)
+        alpha = pixels[:, 3]
+        lo = pixels[:, :3].min(1)
+        hi = pixels[:, :3].max(1)
+        self.opaque = bool(alpha.min() == 255)
+        self.binary_alpha = bool(((alpha == 0) | (alpha == 255)).all())
+        self.chroma_range = int((hi - lo).max()) if len(pixels) else 0
+        self.grayscale = self.chroma_range == 0
+
+    def as_dict(self) -> dict:
+        return {
+            "opaque": self.opaque,
+            "binary_alpha": self.binary_alpha,
+            "grayscale": self.grayscale,
+            "chroma_range": self.chroma_range,
+        }
+
+
+def expand(values: np.ndarray, bits: int) -> np.ndarray:
+    """what the PICA reads back from the top bits of 8-bit values"""
+    values = values.astype(np.uint8) & (0xFF << (8 - bits) & 0xFF)
+    return values | (values >> bits)
+
+
+def reconstruct_z(pixels: np.ndarray) -> np.ndarray:
+    # what bump renormalization does with the x and y of a normal
+    xy = pixels[..., :2].astype(np.float32) / 255 * 2 - 1
+    z = np.sqrt(np.clip(1 - (xy**2).sum(-1), 0, 1))
+    return np.rint((z + 1) / 2 * 255).astype(np.uint8)
+
+
+def decode_as(pixels: np.ndarray, format: TextureFormat) -> np.ndarray:
+    """(height, width, 4) pixels as they would be sampled after storing in format"""
+    r, g, b, a = (pixels[..., i] for i in range(4))
+    zero = np.zeros_like(r)
+    full = np.full_like(r, 255)
+    match format:
+        case TextureFormat.RGBA8:
+            channels = r, g, b, a
+        case TextureFormat.RGB8:
+            channels = r, g, b, full
+        case TextureFormat.RGBA5551:
+            channels = (*(expand(c, 5) for c in (r, g, b)), (a >> 7) * full)
+        case TextureFormat.RGB565:
+            channels = expand(r, 5), expand(g, 6), expand(b, 5), full
+        case TextureFormat.RGBA4:
+            channels = tuple(expand(c, 4) for c in (r, g, b, a))
+        case TextureFormat.LA8:
+            l = luminance(r, g, b)
+            channels = l, l, l, a
+        case TextureFormat.HILO8:
+            channels = r, g, zero, full
+        case TextureFormat.L8:
+            l = luminance(r, g, b)
+            channels = l, l, l, full
+        case TextureFormat.A8:
+            channels = zero, zero, zero, a
+        case TextureFormat.LA4:
+            l = expand(luminance(r, g, b), 4)
+            channels = l, l, l, expand(a, 4)
+        case TextureFormat.L4:
+            l = expand(luminance(r, g, b), 4)
+            channels = l, l, l, full
+        case TextureFormat.A4:
+            channels = zero, zero, zero, expand(a, 4)
+        case TextureFormat.ETC1 | TextureFormat.ETC1A4:
+            alpha = format == TextureFormat.ETC1A4
+            height, width = pixels.shape[:2]
+            data = etc1.encode(pixels, alpha, ETC1Quality.Fast, workers=1)
+            return etc1.decode(data, width, height, alpha)
+    return np.stack(channels, axis=-1)
+
+
+def psnr(a: np.ndarray, b: np.ndarray) -> float:
+    mse = ((a.astype(np.float64) - b) ** 2).mean()
+    if mse == 0:
+        return float("inf")
+    return float(10 * np.log10(255**2 / mse))
+
+
+class TextureAnalysis:
+    stats: TextureStats
+    # estimated PSNR of each candidate format that was tried
+    psnr: dict[TextureFormat, float]
+    format: TextureFormat
+
+    def __init__(self, im: Image, min_psnr: float, normal: bool = False):
+        """
+        Picks the smallest format that keeps im above min_psnr.
+        Normal maps are compared on their direction only, ignoring alpha.
+        """
+        # partial tiles aren't stored, so they don't count
+        width, height = im.width // 8 * 8, im.height // 8 * 8
+        pixels = np.asarray(im.convert("RGBA"))[:height, :width]
+        self.stats = TextureStats(pixels)
+        self.psnr = {}
+        candidates = NORMAL_CANDIDATES if normal else COLOR_CANDIDATES
+        if not normal and not self.stats.opaque:
+            candidates = [f for f in candidates if f in ALPHA_FORMATS]
+
+        self.format = None
+        for format in sorted(candidates, key=lambda f: f.bits_per_pixel()):
+            if self.format and format.bits_per_pixel() > self.format.bits_per_pixel():
+                break
+            decoded = decode_as(pixels, format)
+            if normal:
+                if format == TextureFormat.HILO8:
+                    decoded[..., 2] = reconstruct_z(decoded)
+                self.psnr[format] = psnr(decoded[..., :3], pixels[..., :3])
+            else:
+                self.psnr[format] = psnr(decoded, pixels)
+            if self.psnr[format] >= min_psnr and (
+                self.format is None or self.psnr[format] > self.psnr[self.format]
+            ):
+                self.format = format
+        if self.format is None:
+            # nothing is good enough, so use the most accurate one
+            self.format = max(self.psnr, key=self.psnr.get)
+
+    def as_dict(self) -> dict:
+        return {
+            "format": self.format.name,
+            "stats": self.stats.as_dict(),
+            # lossless formats have no PSNR
+            "psnr": {
+                f.name: round(p, 2) if p != float("inf") else None
+                for f, p in self.psnr.items()
+            },
+        }
@@ -0,0 +1,101 @@
+from .txob import ImageTexture, TextureFormat
+
+PAGE_SIZE = 256
+
+
+def next_power_of_two(n: int) -> int:
+    return max(8, 1 << (n - 1).bit_length())
+
+
+class Shelf:
+    y: int
+    height: int
+    # how far along the shelf is filled
+    width = 0
+
+    def __init__(self, y: int, height: int) -> None:
+        self.y = y
+        self.height = height
+
+
+class Page:
+    shelves: list[Shelf]
+    # how far down the shelves go
+    height = 0
+    # (texture index, x, y) of everything on the page
+    placements: list[tuple[int, int, int]]
+
+    def __init__(self) -> None:
+        self.shelves = []
+        self.placements = []
+
+    def place(self, index: int, width: int, height: int, size: int) -> bool:
+        for shelf in self.shelves:
+            if height <= shelf.height and shelf.width + width <= size:
+                break
+        else:
+            if self.height + height > size:
+                return False
+            shelf = Shelf(self.height, height)
+            self.shelves.append(shelf)
+            self.height += height
+        self.placements.append((index, shelf.width, shelf.y))
+        shelf.width += width
+        return True
+
+    def dimensions(self) -> tuple[int, int]:
+        """the smallest texture size holding everything on the page"""
+        width = max(shelf.width for shelf in self.shelves)
+        return next_power_of_two(width), next_power_of_two(self.height)
+
+
+def pack(sizes: list[tuple[int, int]], size: int = PAGE_SIZE) -> list[Page]:
+    """
+    Packs (width, height) rectangles onto pages of size x size with first fit
+    shelf packing, tallest first. Positions are from the top left corner.
+    """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0], i))
+    pages = []
+    for i in order:
+        width, height = sizes[i]
+        for page in pages:
+            if page.place(i, width, height, size):
+                break
+        else:
+            page = Page()
+            page.place(i, width, height, size)
+            pages.append(page)
+    return pages
+
+
+def tile_bytes(format: TextureFormat) -> int:
+    return 64 * format.bits_per_pixel() // 8
+
+
+def build_page(
+    textures: list[ImageTexture], page: Page, format: TextureFormat
+) -> ImageTexture:
+    """
+    Copies the tiles of each texture onto the page without re-encoding them.
+    Textures are stored upside down, so a texture y pixels from the top of the page
+    starts y + height pixels from the bottom of the stored data.
+    """
+    width, height = page.dimensions()
+    size = tile_bytes(format)
+    data = bytearray(format.data_size(width, height))
+    for index, x, y in page.placements:
+        txob = textures[index]
+        row = txob.width // 8 * size
+        bottom = height - y - txob.height
+        for ty in range(txob.height // 8):
+            start = ((bottom // 8 + ty) * (width // 8) + x // 8) * size
+            data[start : start + row] = txob.pixel_based_image.data[
+                ty * row : (ty + 1) * row
+            ]
+    atlas = ImageTexture()
+    atlas.width = atlas.pixel_based_image.width = width
+    atlas.height = atlas.pixel_based_image.height = height
+    atlas.hw_format = format
+    atlas.mipmap_level_count = 1
+    atlas.pixel_based_image.data = bytes(data)
+    return atlas
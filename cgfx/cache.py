@@ -0,0 +1,98 @@
+import hashlib
+import os
+import tempfile
+
+# bump when encoders change, so old entries stop being used
+CACHE_VERSION = 2
+
+
+class EncodeCache:
+    """
+    Content-addressed store of encoded data on disk.
+    Entries are written to a temporary file and renamed into place, so
+    processes sharing a directory only ever see complete entries.
+    evict() removes the least recently used entries once max_size bytes is exceeded.
+    It scans the whole directory, so it's called once after a batch of puts
+    rather than by put itself.
+    """
+
+    path: str
+    max_size: int
+
+    def __init__(self, path: str, max_size: int = 256 << 20) -> None:
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(data: bytes, *params) -> str:
+        h = hashlib.sha256(data)
+        h.update(repr((CACHE_VERSION, *params)).encode())
+        return h.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key: str) -> bytes | None:
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            # the modification time doubles as the last use
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self.entry_path(key)
+        tmp = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            tmp = None
+        except OSError as e:
+            # a cache that can't be written to shouldn't stop a conversion
+            print(f"WARNING: could not write to texture cache: {e}")
+        finally:
+            # entries() skips temporary files, so they'd never be evicted
+            if tmp is not None:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        """(last use, size, path) of every entry"""
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(".tmp"):
+                    # still being written by another process
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
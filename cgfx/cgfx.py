@@ -95,3 +95,8 @@ class CGFX(InlineObject):
 
     def values(self) -> tuple:
         return (self.header, self.data)
+
+    def real_values(self, strings, imag) -> list:
+        # the header and section sizes are filled in after prepare()
+        self.layout = self.make_layout()
+        return super().real_values(strings, imag)
@@ -32,15 +32,23 @@ class Node(InlineObject, Generic[T]):
 class DICT(StandardObject, Generic[T]):
     signature = Signature("DICT")
     nodes: list[Node]
+    # maps each name to its position in nodes
+    index: dict[str, int]
+    # the patricia tree is only needed for output, so it's built once on demand
+    # rather than after every insertion
+    dirty = False
 
     def __init__(self) -> None:
         super().__init__()
         self.nodes = [Node(None, None)]
+        self.index = {None: 0}
 
     def refresh_struct(self):
         self.struct = Struct("4sii" + Node.struct.format * len(self.nodes))
 
     def values(self) -> tuple:
+        if self.dirty:
+            self.regenerate()
         self.refresh_struct()
         return (self.signature, self.struct.size, self.len()) + tuple(self.nodes)
 
@@ -50,26 +58,48 @@ class DICT(StandardObject, Generic[T]):
     def __getitem__(self, name: str) -> T:
         if isinstance(name, int):
             return self.nodes[name + 1].content
-        # could be smarter but eh
-        for n in self.nodes:
-            if n.name == name:
-                return n.content
-        return None
+        i = self.find(name)
+        return self.nodes[i].content if i is not None else None
 
     def __iter__(self):
         for n in self.nodes[1:]:
             yield n.name
 
+    def __contains__(self, name: str) -> bool:
+        # the root node isn't an entry
+        return bool(self.find(name))
+
     def get_index(self, name: str) -> int:
-        for i in range(len(self.nodes)):
-            if self.nodes[i].name == name:
-                return i - 1
+        i = self.find(name)
+        return i - 1 if i is not None else None
+
+    def find(self, name: str) -> int | None:
+        """returns the position of the first node with this name in self.nodes"""
+        i = self.index.get(name)
+        if i is not None and (i >= len(self.nodes) or self.nodes[i].name != name):
+            # nodes were rearranged behind our back
+            self.reindex()
+            i = self.index.get(name)
+        return i
+
+    def reindex(self):
+        self.index = {}
+        for i, n in enumerate(self.nodes):
+            self.index.setdefault(n.name, i)
 
     def add(self, name: str, data: T):
+        self.index.setdefault(name, len(self.nodes))
         self.nodes.append(Node(name, data))
-        self.regenerate()
+        self.dirty = True
+
+    def sort(self, key, start: int = 0):
+        """sorts the entries from index start onwards, using key on each Node"""
+        self.nodes[start + 1 :] = sorted(self.nodes[start + 1 :], key=key)
+        self.reindex()
+        self.dirty = True
 
     def regenerate(self):
+        self.dirty = False
         tree = patricia.generate(
             [n.get_name() for n in self.nodes if n != self.nodes[0]]
         )
@@ -108,5 +138,8 @@ class DictInfo(InlineObject, Generic[T]):
     def __iter__(self):
         return iter(self.dict)
 
+    def __contains__(self, name: str) -> bool:
+        return name in self.dict
+
     def get_index(self, name: str) -> int:
         return self.dict.get_index(name)
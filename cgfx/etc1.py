@@ -0,0 +1,242 @@
+from concurrent.futures import ProcessPoolExecutor
+from enum import IntEnum
+from itertools import product, repeat
+import numpy as np
+
+# intensity modifiers for each table, as (small, large)
+MODIFIERS = np.array(
+    [[2, 8], [5, 17], [9, 29], [13, 42], [18, 60], [24, 80], [33, 106], [47, 183]]
+)
+# pixel index -> modifier, the index being (negate << 1) | large
+DELTAS = np.stack(
+    (MODIFIERS[:, 0], MODIFIERS[:, 1], -MODIFIERS[:, 0], -MODIFIERS[:, 1]), axis=1
+).astype(np.int32)
+
+# pixels are numbered in column-major order within a block
+# with flip off, the two halves are side by side, otherwise they're stacked
+HALVES = (
+    (np.arange(0, 8), np.arange(8, 16)),
+    (
+        np.array([0, 1, 4, 5, 8, 9, 12, 13]),
+        np.array([2, 3, 6, 7, 10, 11, 14, 15]),
+    ),
+)
+
+# blocks per unit of work
+CHUNK_SIZE = 1024
+
+
+class ETC1Quality(IntEnum):
+    Fast = 0
+    Medium = 1
+    Exhaustive = 2
+
+    def offsets(self) -> list[tuple[int, int, int]]:
+        """offsets from the average colour that are tried as base colours"""
+        if self == ETC1Quality.Fast:
+            return [(0, 0, 0)]
+        if self == ETC1Quality.Medium:
+            # only along the grey axis, the tables make up the rest
+            return [(i, i, i) for i in range(-2, 3)]
+        return list(product(range(-1, 2), repeat=3))
+
+
+def expand(q: np.ndarray, bits: int) -> np.ndarray:
+    if bits == 4:
+        return q * 17
+    return (q << 3) | (q >> 2)
+
+
+def fit(pixels: np.ndarray, bases: np.ndarray) -> tuple[np.ndarray, ...]:
+    """
+    Picks the best table and pixel indices for each half block, given its base colour.
+    pixels is (N, 8, 3), bases is (N, 3) in 8-bit.
+    Returns the error, table and indices of each half.
+    """
+    # (N, tables, pixels, indices, channels)
+    colors = np.clip(
+        bases[:, None, None, None, :] + DELTAS[None, :, None, :, None], 0, 255
+    )
+    errors = ((colors - pixels[:, None, :, None, :]) ** 2).sum(-1)
+    indices = errors.argmin(-1)
+    table_errors = errors.min(-1).sum(-1)
+    tables = table_errors.argmin(-1)
+    n = np.arange(len(pixels))
+    return table_errors[n, tables], tables, indices[n, tables]
+
+
+def search(
+    pixels: np.ndarray, bits: int, quality: ETC1Quality, lo=None, hi=None
+) -> tuple[np.ndarray, ...]:
+    """
+    Searches base colours of the given precision around the average of each half block,
+    optionally constrained to [lo, hi]. Returns the error, base, table and indices.
+    """
+    center = np.rint(pixels.mean(1) * ((1 << bits) - 1) / 255).astype(np.int32)
+    best = None
+    for offset in quality.offsets():
+        base = np.clip(center + offset, 0, (1 << bits) - 1)
+        if lo is not None:
+            base = np.clip(base, lo, hi)
+        error, table, indices = fit(pixels, expand(base, bits))
+        if best is None:
+            best = [error, base, table, indices]
+            continue
+        better = error < best[0]
+        best[0] = np.where(better, error, best[0])
+        best[1] = np.where(better[:, None], base, best[1])
+        best[2] = np.where(better, table, best[2])
+        best[3] = np.where(better[:, None], indices, best[3])
+    return tuple(best)
+
+
+def encode_colors(blocks: np.ndarray, quality: ETC1Quality) -> np.ndarray:
+    """blocks is (N, 16, 3), returns the ETC1 words"""
+    n = len(blocks)
+    best_error = np.full(n, np.iinfo(np.int64).max)
+    words = np.zeros(n, dtype=np.uint64)
+    for flip, (first, second) in enumerate(HALVES):
+        a = blocks[:, first]
+        b = blocks[:, second]
+        candidates = []
+
+        # individual mode: two 4-bit colours
+        err_a, base_a, table_a, idx_a = search(a, 4, quality)
+        err_b, base_b, table_b, idx_b = search(b, 4, quality)
+        colors = (base_a << 4) | base_b
+        candidates.append(
+            (err_a + err_b, colors, False, table_a, table_b, idx_a, idx_b)
+        )
+
+        # differential mode: a 5-bit colour and a 3-bit signed offset from it
+        # either half can be the unconstrained one
+        for free_first in (True, False):
+            if free_first:
+                err_a, base_a, table_a, idx_a = search(a, 5, quality)
+                err_b, base_b, table_b, idx_b = search(
+                    b, 5, quality, base_a - 4, base_a + 3
+                )
+            else:
+                err_b, base_b, table_b, idx_b = search(b, 5, quality)
+                err_a, base_a, table_a, idx_a = search(
+                    a, 5, quality, base_b - 3, base_b + 4
+                )
+            colors = (base_a << 3) | ((base_b - base_a) & 7)
+            candidates.append(
+                (err_a + err_b, colors, True, table_a, table_b, idx_a, idx_b)
+            )
+
+        for error, colors, differential, table_a, table_b, idx_a, idx_b in candidates:
+            better = error < best_error
+            best_error = np.where(better, error, best_error)
+            indices = np.zeros((n, 16), dtype=np.uint64)
+            indices[:, first] = idx_a
+            indices[:, second] = idx_b
+            colors = colors.astype(np.uint64)
+            word = (
+                (colors[:, 0] << np.uint64(56))
+                | (colors[:, 1] << np.uint64(48))
+                | (colors[:, 2] << np.uint64(40))
+                | (table_a.astype(np.uint64) << np.uint64(37))
+                | (table_b.astype(np.uint64) << np.uint64(34))
+                | np.uint64((differential << 1) | flip) << np.uint64(32)
+            )
+            shifts = np.arange(16, dtype=np.uint64)
+            word |= ((indices >> np.uint64(1)) << (shifts + np.uint64(16))).sum(
+                1, dtype=np.uint64
+            )
+            word |= ((indices & np.uint64(1)) << shifts).sum(1, dtype=np.uint64)
+            words = np.where(better, word, words)
+    return words
+
+
+def encode_chunk(blocks: np.ndarray, alpha: bool, quality: ETC1Quality) -> bytes:
+    words = encode_colors(blocks[:, :, :3].astype(np.int32), quality)
+    if alpha:
+        shifts = np.arange(0, 64, 4, dtype=np.uint64)
+        alphas = ((blocks[:, :, 3].astype(np.uint64) >> np.uint64(4)) << shifts).sum(
+            1, dtype=np.uint64
+        )
+        words = np.stack((alphas, words), axis=-1)
+    # blocks are stored as little endian 64-bit words
+    return words.astype("<u8").tobytes()
+
+
+def to_blocks(pixels: np.ndarray) -> np.ndarray:
+    """
+    Splits (height, width, 4) pixels into 4x4 blocks in PICA order:
+    8x8 tiles in row-major order, each made of 4 blocks in row-major order.
+    Partial tiles at the edges are dropped.
+    """
+    th, tw = pixels.shape[0] // 8, pixels.shape[1] // 8
+    pixels = pixels[: th * 8, : tw * 8]
+    # (tile y, block y, y, tile x, block x, x, channel)
+    blocks = pixels.reshape(th, 2, 4, tw, 2, 4, 4)
+    # pixels within a block are column-major
+    return blocks.transpose(0, 3, 1, 4, 5, 2, 6).reshape(-1, 16, 4)
+
+
+def from_blocks(blocks: np.ndarray, width: int, height: int) -> np.ndarray:
+    """the inverse of to_blocks"""
+    blocks = blocks.reshape(height // 8, width // 8, 2, 2, 4, 4, 4)
+    return blocks.transpose(0, 2, 5, 1, 3, 4, 6).reshape(height, width, 4)
+
+
+def decode_colors(words: np.ndarray) -> np.ndarray:
+    """words is (N,) ETC1 words, returns (N, 16, 3) colours"""
+    words = words[:, None]
+    shifts = np.array([56, 48, 40], dtype=np.uint64)
+    # individual mode
+    first = expand(((words >> (shifts + np.uint64(4))) & np.uint64(15)), 4)
+    second = expand(((words >> shifts) & np.uint64(15)), 4)
+    # differential mode
+    base = (words >> (shifts + np.uint64(3))) & np.uint64(31)
+    offset = ((words >> shifts) & np.uint64(7)).astype(np.int64)
+    offset -= (offset & 4) << 1
+    differential = ((words >> np.uint64(33)) & np.uint64(1)).astype(bool)
+    first = np.where(differential, expand(base, 5), first).astype(np.int32)
+    second = np.where(
+        differential, expand(base.astype(np.int64) + offset, 5), second
+    ).astype(np.int32)
+
+    p = np.arange(16, dtype=np.uint64)
+    flip = ((words >> np.uint64(32)) & np.uint64(1)).astype(bool)
+    # (N, 16), whether each pixel is in the second half
+    in_second = np.where(flip, (p % 4) >= 2, (p // 4) >= 2)
+    tables = np.where(
+        in_second, (words >> np.uint64(34)) & np.uint64(7), words >> np.uint64(37)
+    ) & np.uint64(7)
+    indices = (((words >> (p + np.uint64(16))) & np.uint64(1)) << np.uint64(1)) | (
+        (words >> p) & np.uint64(1)
+    )
+    deltas = DELTAS[tables.astype(np.intp), indices.astype(np.intp)]
+    bases = np.where(in_second[..., None], second[:, None], first[:, None])
+    return np.clip(bases + deltas[..., None], 0, 255).astype(np.uint8)
+
+
+def decode(data: bytes, width: int, height: int, alpha: bool) -> np.ndarray:
+    """Decodes ETC1 or ETC1A4 data to (height, width, 4) RGBA pixels."""
+    words = np.frombuffer(data, dtype="<u8").astype(np.uint64)
+    if alpha:
+        alphas, words = words[0::2], words[1::2]
+        shifts = np.arange(0, 64, 4, dtype=np.uint64)
+        a = expand((alphas[:, None] >> shifts) & np.uint64(15), 4).astype(np.uint8)
+    else:
+        a = np.full((len(words), 16), 255, dtype=np.uint8)
+    blocks = np.concatenate((decode_colors(words), a[..., None]), axis=-1)
+    return from_blocks(blocks, width, height)
+
+
+def encode(
+    pixels: np.ndarray,
+    alpha: bool,
+    quality: ETC1Quality = ETC1Quality.Medium,
+    workers: int | None = None,
+) -> bytes:
+    """Encodes (height, width, 4) RGBA pixels as ETC1, or ETC1A4 if alpha is set."""
+    blocks = to_blocks(pixels)
+    chunks = [blocks[i : i + CHUNK_SIZE] for i in range(0, len(blocks), CHUNK_SIZE)]
+    if workers == 1 or len(chunks) <= 1:
+        return b"".join(encode_chunk(c, alpha, quality) for c in chunks)
+    with ProcessPoolExecutor(workers) as pool:
+        return b"".join(pool.map(encode_chunk, chunks, repeat(alpha), repeat(quality)))
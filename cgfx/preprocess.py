@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+import time
+import numpy as np
+
+
+class StageTimer:
+    """how long each stage of preparing a texture took"""
+
+    # stage name -> seconds
+    stages: dict[str, float]
+
+    def __init__(self) -> None:
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def as_dict(self) -> dict[str, float]:
+        # in milliseconds
+        return {name: round(t * 1000, 3) for name, t in self.stages.items()}
+
+
+@contextmanager
+def timed(timer: StageTimer | None, name: str):
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
+
+
+def invert_channels(pixels: np.ndarray, channels=(0, 1)) -> np.ndarray:
+    """
+    Inverts the given channels of (height, width, 4) pixels, making them opaque.
+    glTF normal maps point X and Y the opposite way to the PICA.
+    """
+    pixels = pixels.copy()
+    pixels[..., channels] = 255 - pixels[..., channels]
+    pixels[..., 3] = 255
+    return pixels
+
+
+def renormalize(pixels: np.ndarray) -> np.ndarray:
+    """
+    Scales the RGB of each pixel back to a unit vector,
+    which filtering and mipmapping shorten. Zero vectors become flat normals.
+    """
+    v = pixels[..., :3].astype(np.float32) / 127.5 - 1
+    length = np.sqrt((v**2).sum(-1, keepdims=True))
+    flat = np.array([0, 0, 1], dtype=np.float32)
+    v = np.where(length > 1e-6, v / np.maximum(length, 1e-6), flat)
+    pixels = pixels.copy()
+    pixels[..., :3] = np.clip(np.rint((v + 1) * 127.5), 0, 255)
+    return pixels
+
+
+class NormalMapPreprocessor:
+    """
+    prepares each mipmap level of a normal map before it's swizzled.
+    HILO8, the only two channel format that can hold a normal, stores red and green,
+    so X and Y need no moving
+    """
+
+    renormalize = False
+
+    def __init__(self, renormalize: bool = False) -> None:
+        self.renormalize = renormalize
+
+    def __call__(self, pixels: np.ndarray, timer: StageTimer | None = None):
+        if self.renormalize:
+            with timed(timer, "renormalize"):
+                pixels = renormalize(pixels)
+        return pixels
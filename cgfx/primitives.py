@@ -7,9 +7,17 @@ class DataType(IntEnum):
     Byte = 0x1400
     UByte = 0x1401
     Short = 0x1402
+    # only used for indices
+    UShort = 0x1403
     Float = 0x1406
 
 
+class PrimitiveMode(IntEnum):
+    Triangles = 0
+    TriangleStrip = 1
+    TriangleFan = 2
+
+
 class VertexAttributeUsage(IntEnum):
     Position = 0
     Normal = 1
@@ -44,7 +52,7 @@ class VertexAttributeFlag(IntFlag):
 class IndexStream(StandardObject):
     struct = Struct("ib?xxiiiiiiiii")
     data_type = DataType.UByte
-    primitive_mode = 0
+    primitive_mode = PrimitiveMode.Triangles
     visible = True
     face_data: b""
     buffer_object = 0
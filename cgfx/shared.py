@@ -1,10 +1,16 @@
 from abc import ABC, abstractmethod
 import struct
+import hashlib
 from collections import OrderedDict
+from enum import IntEnum
+from functools import cache
 from typing import Generic, TypeVar
 
 T = TypeVar("T")
 
+# anything in values() of these types is stored in the IMAG block
+DATA_TYPES = (bytes, bytearray, memoryview)
+
 
 class Signature:
     data: str
@@ -54,13 +60,179 @@ class StringTable:
     def get(self, s: str) -> int:
         return self.offset + self.table[self.correct(s)]
 
-    def write(self) -> bytes:
-        return b"".join(self.table.keys()) + b"\0" * self.padding
+    def write_into(self, buffer):
+        pos = self.offset
+        for s in self.table.keys():
+            buffer[pos : pos + len(s)] = s
+            pos += len(s)
+        buffer[pos : pos + self.padding] = bytes(self.padding)
+
+    def write_to(self, fp):
+        for s in self.table.keys():
+            fp.write(s)
+        fp.write(bytes(self.padding))
+
+
+@cache
+def field_offsets(fmt: str) -> tuple[int, ...]:
+    """offset of each field in a struct format, relative to the start of the struct"""
+    offsets = []
+    i = 0
+    while i < len(fmt):
+        if fmt[i] == "x":
+            i += 1
+            continue
+        start = i
+        while fmt[i].isdigit():
+            i += 1
+        if i != start and fmt[start : i + 1] != "4s":
+            raise RuntimeError(
+                f"can't use numbers other than 4s (found {fmt[start:i+1]})"
+            )
+        # padding before a field counts towards it
+        offsets.append(struct.calcsize(fmt[:start]) if offsets else 0)
+        i += 1
+    return tuple(offsets)
+
+
+def encode_standard_object(values, v, offset, strings, imag):
+    values.append(v.offset - offset)
+
+
+def encode_reference(values, v, offset, strings, imag):
+    values.append(0 if v.obj is None else v.obj.offset - offset)
+
+
+def encode_signature(values, v, offset, strings, imag):
+    values.append(v.data.encode())
+
+
+def encode_string(values, v, offset, strings, imag):
+    values.append(strings.get(v) - offset)
+
+
+def encode_data(values, v, offset, strings, imag):
+    # data takes two fields, the size and then the pointer
+    values.append(memoryview(v).nbytes)
+    values.append(imag.get(v) - (offset + 4) if v else 0)
+
+
+def encode_null(values, v, offset, strings, imag):
+    values.append(0)
+
+
+def encode_plain(values, v, offset, strings, imag):
+    values.append(v)
+
+
+# encoders are resolved once per type, see find_encoder
+ENCODERS = {}
+
+
+def find_encoder(t: type):
+    if issubclass(t, StandardObject):
+        encoder = encode_standard_object
+    elif issubclass(t, Reference):
+        encoder = encode_reference
+    elif issubclass(t, Signature):
+        encoder = encode_signature
+    elif issubclass(t, str):
+        encoder = encode_string
+    elif issubclass(t, DATA_TYPES):
+        encoder = encode_data
+    elif t is type(None):
+        encoder = encode_null
+    else:
+        encoder = encode_plain
+    ENCODERS[t] = encoder
+    return encoder
+
+
+class ValueKind(IntEnum):
+    Plain = 0
+    Inline = 1
+    Child = 2
+    String = 3
+    Data = 4
+
+
+@cache
+def value_kind(t: type) -> ValueKind:
+    """how the layout pass treats values of a type, cached as isinstance is slow on ABCs"""
+    if issubclass(t, InlineObject):
+        return ValueKind.Inline
+    if issubclass(t, StandardObject):
+        return ValueKind.Child
+    if issubclass(t, str):
+        return ValueKind.String
+    if issubclass(t, DATA_TYPES):
+        return ValueKind.Data
+    return ValueKind.Plain
+
+
+class BlobTable(StringTable):
+    """
+    Holds the IMAG data as views of the buffers it came from, without copying it.
+    Blobs are deduplicated by a digest of their content rather than by the content itself.
+    """
+
+    table: dict[tuple[int, bytes], int]
+    blobs: list[memoryview]
+    # id of each added object -> (object, offset), to skip digesting on lookup
+    ids: dict[int, tuple[object, int]]
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.table = {}
+        self.blobs = []
+        self.ids = {}
+
+    @staticmethod
+    def digest(view: memoryview) -> tuple[int, bytes]:
+        # same padding as StringTable.correct, so the same blobs get merged
+        padding = -view.nbytes % 16
+        h = hashlib.blake2b(view, digest_size=16)
+        h.update(bytes(padding))
+        return view.nbytes + padding, h.digest()
+
+    def add(self, s):
+        if id(s) in self.ids:
+            return
+        view = memoryview(s).cast("B")
+        key = self.digest(view)
+        if key not in self.table:
+            self.table[key] = self.total
+            self.blobs.append(view)
+            self.total += key[0]
+        # keep a reference so the id can't be reused
+        self.ids[id(s)] = (s, self.table[key])
+
+    def get(self, s) -> int:
+        if id(s) in self.ids:
+            return self.offset + self.ids[id(s)][1]
+        return self.offset + self.table[self.digest(memoryview(s).cast("B"))]
+
+    def chunks(self):
+        for view in self.blobs:
+            yield view
+            if view.nbytes % 16:
+                yield bytes(-view.nbytes % 16)
+        yield bytes(self.padding)
+
+    def write_into(self, buffer):
+        pos = self.offset
+        for chunk in self.chunks():
+            buffer[pos : pos + len(chunk)] = chunk
+            pos += len(chunk)
+
+    def write_to(self, fp):
+        fp.writelines(self.chunks())
 
 
 class BaseObject(ABC):
     struct: struct.Struct
     offset: int
+    layout: "Layout"
     inline = False
 
     def refresh_struct(self):
@@ -73,7 +245,7 @@ class BaseObject(ABC):
     def flat_values(self):
         self.refresh_struct()
         for v in self.values():
-            if isinstance(v, InlineObject):
+            if value_kind(type(v)) is ValueKind.Inline:
                 # v.refresh_struct()
                 # vals = list(v.flat_values())
                 # bufs = []
@@ -90,91 +262,49 @@ class BaseObject(ABC):
             else:
                 yield v
 
-    def real_values(self, strings, imag) -> tuple:
+    def real_values(self, strings, imag) -> list:
+        offsets = field_offsets(self.struct.format)
         values = []
-        fmt_pos = 0
-        offset = self.offset
-        for v in self.flat_values():
-            # add values
-            if isinstance(v, StandardObject):
-                values.append(v.offset - offset)
-            elif isinstance(v, InlineObject):
-                values += list(v.real_values(strings, imag))
-            elif isinstance(v, Reference):
-                if v.obj is None:
-                    values.append(0)
-                else:
-                    values.append(v.obj.offset - offset)
-            elif isinstance(v, Signature):
-                values.append(v.data.encode())
-            elif isinstance(v, str):
-                # string
-                values.append(strings.get(v) - offset)
-            elif isinstance(v, bytes):
-                # data
-                values.append(len(v))
-                offset += 4
-                fmt_pos += 1
-                values.append(imag.get(v) - offset if v else 0)
-            elif v is None:
-                # null
-                values.append(0)
-            else:
-                values.append(v)
-            # update offset
-            if isinstance(v, InlineObject):
-                fmt_pos += v.size()
-            else:
-                fmt_pos += 1
-                while fmt_pos < len(self.struct.format):
-                    if self.struct.format[fmt_pos] == "x":
-                        fmt_pos += 1
-                        continue
-                    try:
-                        offset = self.offset + struct.calcsize(
-                            self.struct.format[:fmt_pos]
-                        )
-                        break
-                    except struct.error:
-                        if self.struct.format[fmt_pos - 1 : fmt_pos + 1] != "4s":
-                            raise RuntimeError(
-                                f"can't use numbers other than 4s (found {self.struct.format[fmt_pos:fmt_pos+2]})"
-                            )
-                        fmt_pos += 1
-                        continue
+        for v in self.layout.values:
+            encoder = ENCODERS.get(type(v)) or find_encoder(type(v))
+            # every value so far has produced one field each
+            encoder(values, v, self.offset + offsets[len(values)], strings, imag)
         return values
 
+    def make_layout(self) -> "Layout":
+        return Layout(list(self.flat_values()))
+
     def prepare(self, offset: int, strings: StringTable, imag: StringTable) -> int:
         """offset is current offset, returns new offset"""
-        self.refresh_struct()
         self.offset = offset
-        values = self.values()
-        old_len = 0
-        while old_len != len(values):
-            old_len = len(values)
-            values = [
-                vv
-                for v in values
-                for vv in (v.values() if isinstance(v, InlineObject) else [v])
-            ]
-        offset = self.offset + self.size()
-        for v in values:
-            if isinstance(v, StandardObject):
+        # values() is evaluated once per serialization, write_into reuses this
+        self.layout = self.make_layout()
+        offset = self.offset + self.struct.size
+        for v in self.layout.values:
+            kind = value_kind(type(v))
+            if kind is ValueKind.Child:
                 offset = v.prepare(offset, strings, imag)
-            elif isinstance(v, str):
+            elif kind is ValueKind.String:
                 # string (not signature)
                 strings.add(v)
-            elif isinstance(v, bytes):
+            elif kind is ValueKind.Data:
                 imag.add(v)
         return offset
 
-    def write(self, strings: StringTable, imag: StringTable) -> bytes:
+    def write_into(self, buffer, strings: StringTable, imag: StringTable):
+        """packs this object and its children into buffer at their prepared offsets"""
         values = self.real_values(strings, imag)
-        data = self.struct.pack(*values)
-        for v in self.flat_values():
-            if isinstance(v, StandardObject):
-                data += v.write(strings, imag)
-        return data
+        self.struct.pack_into(buffer, self.offset, *values)
+        for v in self.layout.children:
+            v.write_into(buffer, strings, imag)
+
+    def write_to(self, fp, strings: StringTable, imag: StringTable):
+        """streams this object and its children to fp, which must be at self.offset"""
+        # children are prepared in the order they're visited here,
+        # so everything comes out sequentially
+        fp.write(self.struct.pack(*self.real_values(strings, imag)))
+        for v in self.layout.children:
+            v.write_to(fp, strings, imag)
 
     def size(self) -> int:
         self.refresh_struct()
@@ -188,6 +318,17 @@ class StandardObject(BaseObject):
     pass
 
 
+class Layout:
+    """an object's flattened values, as captured by prepare()"""
+
+    values: list
+    children: list[StandardObject]
+
+    def __init__(self, values: list) -> None:
+        self.values = values
+        self.children = [v for v in values if value_kind(type(v)) is ValueKind.Child]
+
+
 class InlineObject(BaseObject):
     pass
 
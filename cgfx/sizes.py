@@ -0,0 +1,213 @@
+import json
+import struct
+import numpy as np
+from .cgfx import CGFX, CGFXData, CGFXHeader
+from .canm import AnimationCurve
+from .dict import DICT, Node
+from .primitives import IndexStream, VertexAttribute
+from .shared import (
+    BaseObject,
+    BlobTable,
+    StringTable,
+    DATA_TYPES,
+    field_offsets,
+)
+
+# the DICTs in the DATA section, in order
+DATA_DICTS = (
+    "models",
+    "textures",
+    "lookup_tables",
+    "materials",
+    "shaders",
+    "cameras",
+    "lights",
+    "fogs",
+    "scenes",
+    "skeletal_animations",
+    "material_animations",
+    "visibility_animations",
+    "camera_animations",
+    "light_animations",
+    "emitters",
+)
+
+
+class SizeReport:
+    """every byte of a file, attributed to whatever it belongs to"""
+
+    # (owner, section) -> bytes
+    entries: dict[tuple[str, str], int]
+    total: int
+
+    def __init__(self, total: int) -> None:
+        self.entries = {}
+        self.total = total
+
+    def add(self, owner: str, section: str, size: int):
+        if size:
+            key = (owner, section)
+            self.entries[key] = self.entries.get(key, 0) + size
+
+    def sorted_entries(self) -> list[tuple[str, str, int]]:
+        return sorted(
+            ((owner, section, size) for (owner, section), size in self.entries.items()),
+            key=lambda e: (-e[2], e[0], e[1]),
+        )
+
+    def as_dict(self) -> dict:
+        return {
+            "total": self.total,
+            "entries": [
+                {"owner": owner, "section": section, "bytes": size}
+                for owner, section, size in self.sorted_entries()
+            ],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=2)
+
+    def format_table(self) -> str:
+        lines = [f"{'bytes':>8} {'%':>6}  {'section':<8} owner"]
+        for owner, section, size in self.sorted_entries():
+            lines.append(f"{size:>8} {size / self.total:>6.1%}  {section:<8} {owner}")
+        lines.append(f"{self.total:>8} {1:>6.1%}  total")
+        return "\n".join(lines)
+
+
+def owner_of(obj: BaseObject, parent: BaseObject | None, owner: str) -> str:
+    if isinstance(obj, DICT):
+        return "DICT"
+    if isinstance(obj, IndexStream):
+        return f"{owner} indices"
+    if isinstance(obj, VertexAttribute) and not owner.endswith(" vertices"):
+        return f"{owner} vertices"
+    if isinstance(obj, AnimationCurve):
+        # curves are named after the field holding them
+        field = next((k for k, v in vars(parent).items() if v is obj), None)
+        return f"{owner} {field}" if field else owner
+    name = getattr(obj, "name", None) or getattr(obj, "bone_path", None)
+    if isinstance(name, str) and name:
+        return f"{type(obj).__name__} {name}"
+    return owner
+
+
+def attribute(cgfx: CGFX, strings: StringTable, imag: BlobTable) -> SizeReport:
+    """attributes the bytes of a CGFX that has just been through prepare()"""
+    report = SizeReport(cgfx.header.file_size)
+    # blobs are only counted for the first object using them
+    seen_blobs = set()
+
+    def visit(obj: BaseObject, parent: BaseObject | None, parent_owner: str):
+        owner = owner_of(obj, parent, parent_owner)
+        report.add(owner, "DATA", obj.struct.size)
+        for v in obj.layout.values:
+            if isinstance(v, DATA_TYPES) and memoryview(v).nbytes:
+                offset = imag.get(v)
+                if offset not in seen_blobs:
+                    seen_blobs.add(offset)
+                    size = memoryview(v).nbytes
+                    report.add(owner, "IMAG", size)
+                    report.add("IMAG blob padding", "padding", -size % 16)
+        for child in obj.layout.children:
+            # entries belong to whatever holds the DICT, not the DICT itself
+            visit(child, obj, parent_owner if isinstance(obj, DICT) else owner)
+
+    visit(cgfx, None, "CGFX header")
+    report.add("strings", "strings", strings.size() - strings.padding)
+    report.add("string table padding", "padding", strings.padding)
+    if not imag.empty():
+        report.add("IMAG header", "IMAG", 8)
+    report.add("IMAG alignment padding", "padding", imag.padding)
+    return report
+
+
+def read_string(data: bytes, offset: int) -> str:
+    return data[offset : data.index(b"\0", offset)].decode(errors="replace")
+
+
+def attribute_file(data: bytes) -> SizeReport:
+    """
+    Attributes the bytes of an existing CGFX file.
+    Without the objects, DATA bytes are attributed by address range to the top level
+    entries in the DATA section's DICTs, and IMAG data to the entry that points to it.
+    The string table is assumed to start at the first DICT entry name,
+    as it does in files written by this library.
+    """
+    header = CGFXHeader.struct.unpack_from(data, 0)
+    if header[0] != b"CGFX":
+        raise RuntimeError("not a CGFX file")
+    file_size = header[4]
+    data_offset = header[2]
+    report = SizeReport(file_size)
+    section_size = struct.unpack_from("i", data, data_offset + 4)[0]
+    data_end = data_offset + section_size
+
+    # start of each top level object -> owner
+    starts = {}
+    string_starts = []
+    info_offsets = field_offsets(CGFXData.struct.format)[2:]
+    for i, kind in enumerate(DATA_DICTS):
+        pos = data_offset + info_offsets[i * 2 + 1]
+        count, rel = struct.unpack_from("ii", data, pos - 4)
+        if not count:
+            continue
+        dict_offset = pos + rel
+        starts[dict_offset] = "DICT"
+        # the root node has no entry
+        for n in range(1, count + 1):
+            node = dict_offset + 12 + n * Node.struct.size
+            name_rel, content_rel = struct.unpack_from("ii", data, node + 8)
+            name = read_string(data, node + 8 + name_rel)
+            string_starts.append(node + 8 + name_rel)
+            starts[node + 12 + content_rel] = f"{kind}: {name}"
+    strings_start = min(string_starts, default=data_end)
+
+    header_end = data_offset + CGFXData.struct.size
+    report.add("CGFX header", "DATA", header_end)
+    bounds = sorted(s for s in starts if header_end <= s < strings_start)
+    ranges = list(zip(bounds, bounds[1:] + [strings_start]))
+    if bounds:
+        report.add("unknown", "DATA", bounds[0] - header_end)
+
+    imag_start = imag_end = data_end
+    if header[5] > 1 and data[data_end : data_end + 4] == b"IMAG":
+        imag_start = data_end + 8
+        imag_size = struct.unpack_from("i", data, data_end + 4)[0]
+        imag_end = min(file_size, imag_start + imag_size)
+        report.add("IMAG header", "IMAG", 8)
+
+    # blobs are found through their (size, relative pointer) pairs,
+    # which always point at 16-byte aligned data in the IMAG block
+    words = np.frombuffer(data, dtype="<i4", count=strings_start // 4).astype(np.int64)
+    pos = np.arange(1, len(words)) * 4
+    sizes, targets = words[:-1], pos + words[1:]
+    found = np.nonzero(
+        (sizes > 0)
+        & (targets >= imag_start)
+        & (targets % 16 == 0)
+        & (targets + sizes <= imag_end)
+    )[0]
+    blobs = {}
+    for i in found:
+        target = int(targets[i])
+        if target not in blobs:
+            blobs[target] = (int(sizes[i]), int(pos[i]))
+    attributed = 0
+    for start, end in ranges:
+        report.add(starts[start], "DATA", end - start)
+    for target, (size, where) in sorted(blobs.items()):
+        owner = next((starts[s] for s, e in ranges if s <= where < e), "CGFX header")
+        report.add(owner, "IMAG", size)
+        report.add("IMAG blob padding", "padding", -size % 16)
+        attributed += size + -size % 16
+
+    strings_end = data_end
+    while strings_end > strings_start and data[strings_end - 1] == 0:
+        strings_end -= 1
+    # keep the last terminator with its string
+    strings_end = min(strings_end + 1, data_end)
+    report.add("strings", "strings", strings_end - strings_start)
+    report.add("string table padding", "padding", data_end - strings_end)
+    report.add("IMAG alignment padding", "padding", file_size - imag_start - attributed)
+    return report
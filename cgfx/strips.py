@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def triangle_strips(indices: np.ndarray) -> list[list[int]]:
+    """
+    Greedily walks a triangle list into strips, starting each strip at the first
+    triangle not yet used so the list's order is mostly kept.
+    Every other triangle of a strip is wound the opposite way,
+    so a triangle only continues a strip if its winding matches.
+    """
+    triangles = indices.reshape(-1, 3).tolist()
+    # directed edge -> (triangle, vertex opposite it) for triangles wound along it
+    edges = {}
+    for t, (a, b, c) in enumerate(triangles):
+        edges.setdefault((a, b), []).append((t, c))
+        edges.setdefault((b, c), []).append((t, a))
+        edges.setdefault((c, a), []).append((t, b))
+    used = bytearray(len(triangles))
+
+    def next_triangle(u: int, v: int) -> tuple[int, int] | None:
+        for t, w in edges.get((u, v), ()):
+            if not used[t]:
+                return t, w
+        return None
+
+    strips = []
+    for start, (a, b, c) in enumerate(triangles):
+        if used[start]:
+            continue
+        used[start] = 1
+        # the second triangle of a strip is flipped, so it's wound along (c, b)
+        for strip in ([a, b, c], [b, c, a], [c, a, b]):
+            if next_triangle(strip[2], strip[1]):
+                break
+        while True:
+            p, q = strip[-2], strip[-1]
+            if len(strip) % 2:
+                found = next_triangle(q, p)
+            else:
+                found = next_triangle(p, q)
+            if found is None:
+                break
+            used[found[0]] = 1
+            strip.append(found[1])
+        strips.append(strip)
+    return strips
+
+
+def join_strips(strips: list[list[int]]) -> list[int]:
+    """
+    Joins strips into one with degenerate triangles, which draw nothing.
+    Each strip starts at an even position so its winding is kept.
+    """
+    joined = []
+    for strip in strips:
+        if joined:
+            if len(joined) % 2:
+                joined.append(joined[-1])
+            joined += [joined[-1], strip[0]]
+        joined += strip
+    return joined
+
+
+def stripify(indices: np.ndarray) -> np.ndarray:
+    """the indices of a triangle list as a single triangle strip"""
+    return np.array(join_strips(triangle_strips(indices)), dtype=indices.dtype)
@@ -1,132 +1,207 @@
-from PIL.Image import Image
+from enum import IntEnum
+from functools import cache
+from typing import Callable
+import numpy as np
+from PIL.Image import Image, Resampling, fromarray
 from .txob import PixelBasedImage, TXOB, ImageTexture, TextureFormat
+from . import etc1
+from .etc1 import ETC1Quality
+from .preprocess import StageTimer, timed
 
 
-def swizzle(im: Image, format: TextureFormat) -> bytes:
-    swizzle_map = [
-        0x00,
-        0x01,
-        0x04,
-        0x05,
-        0x10,
-        0x11,
-        0x14,
-        0x15,
-        0x02,
-        0x03,
-        0x06,
-        0x07,
-        0x12,
-        0x13,
-        0x16,
-        0x17,
-        0x08,
-        0x09,
-        0x0C,
-        0x0D,
-        0x18,
-        0x19,
-        0x1C,
-        0x1D,
-        0x0A,
-        0x0B,
-        0x0E,
-        0x0F,
-        0x1A,
-        0x1B,
-        0x1E,
-        0x1F,
-        0x20,
-        0x21,
-        0x24,
-        0x25,
-        0x30,
-        0x31,
-        0x34,
-        0x35,
-        0x22,
-        0x23,
-        0x26,
-        0x27,
-        0x32,
-        0x33,
-        0x36,
-        0x37,
-        0x28,
-        0x29,
-        0x2C,
-        0x2D,
-        0x38,
-        0x39,
-        0x3C,
-        0x3D,
-        0x2A,
-        0x2B,
-        0x2E,
-        0x2F,
-        0x3A,
-        0x3B,
-        0x3E,
-        0x3F,
-    ]
-
-    bpp_input = 4
-
-    input = im.tobytes()
-    output = b""
-
-    for ty in range(im.height // 8):
-        for tx in range(im.width // 8):
-            tile = bytearray(8 * 8 * format.bytes_per_pixel())
-            for y in range(8):
-                for x in range(8):
-                    input_pixel_offset = (
-                        (ty * 8 + y) * im.width + (tx * 8 + x)
-                    ) * bpp_input
-                    pixel = input[input_pixel_offset : input_pixel_offset + bpp_input][
-                        ::-1
-                    ]
-                    match format:
-                        case TextureFormat.RGB8:
-                            pixel = pixel[1:]
-                        case TextureFormat.RGBA5551:
-                            pixel = (
-                                (pixel[0] >> 7)
-                                | ((pixel[1] & 0xF8) >> 2)
-                                | ((pixel[2] & 0xF8) << 3)
-                                | ((pixel[3] & 0xF8) << 8)
-                            ).to_bytes(2, "little")
-                        case TextureFormat.RGB565:
-                            pixel = (
-                                (pixel[1] >> 3)
-                                | ((pixel[2] & 0xFC) << 3)
-                                | ((pixel[3] & 0xF8) << 8)
-                            ).to_bytes(2, "little")
-                        case TextureFormat.RGBA4:
-                            pixel = bytes(
-                                [
-                                    (pixel[0] >> 4) | (pixel[1] & 0xF0),
-                                    (pixel[2] >> 4) | (pixel[3] & 0xF0),
-                                ]
-                            )
-                        case _:
-                            raise RuntimeError(
-                                f"Unsupported pixel format {format.name}"
-                            )
-                    output_pixel_offset = swizzle_map[y * 8 + x] * len(pixel)
-                    tile[output_pixel_offset : output_pixel_offset + len(pixel)] = pixel
-            output += tile
-    return output
+@cache
+def tile_order(width: int, height: int) -> np.ndarray:
+    """
+    Indices of the input pixels in the order they're stored on the PICA:
+    8x8 tiles in row-major order, with the pixels in each tile in Morton order.
+    Partial tiles at the edges are dropped.
+    """
+    # position within a tile -> coordinates, by de-interleaving the bits
+    pos = np.arange(64)
+    x = (pos & 1) | ((pos >> 1) & 2) | ((pos >> 2) & 4)
+    y = ((pos >> 1) & 1) | ((pos >> 2) & 2) | ((pos >> 3) & 4)
+    ty, tx = np.divmod(np.arange((height // 8) * (width // 8)), width // 8)
+    order = (ty[:, None] * 8 + y) * width + tx[:, None] * 8 + x
+    order = order.reshape(-1)
+    order.flags.writeable = False
+    return order
+
+
+def luminance(r, g, b) -> np.ndarray:
+    # same weights and rounding as Pillow's "L" conversion
+    return (
+        (
+            r.astype(np.uint32) * 19595
+            + g.astype(np.uint32) * 38470
+            + b.astype(np.uint32) * 7471
+            + 0x8000
+        )
+        >> 16
+    ).astype(np.uint8)
+
+
+def pack_nibbles(values: np.ndarray) -> np.ndarray:
+    # the first pixel of each pair goes in the low nibble
+    return (values[0::2] >> 4) | (values[1::2] & 0xF0)
+
+
+def encode_rgba8(r, g, b, a) -> np.ndarray:
+    return np.stack((a, b, g, r), axis=-1)
+
+
+def encode_rgb8(r, g, b, a) -> np.ndarray:
+    return np.stack((b, g, r), axis=-1)
+
+
+def encode_rgba5551(r, g, b, a) -> np.ndarray:
+    return (
+        (a.astype(np.uint16) >> 7)
+        | ((b.astype(np.uint16) & 0xF8) >> 2)
+        | ((g.astype(np.uint16) & 0xF8) << 3)
+        | ((r.astype(np.uint16) & 0xF8) << 8)
+    )
+
+
+def encode_rgb565(r, g, b, a) -> np.ndarray:
+    return (
+        (b.astype(np.uint16) >> 3)
+        | ((g.astype(np.uint16) & 0xFC) << 3)
+        | ((r.astype(np.uint16) & 0xF8) << 8)
+    )
+
+
+def encode_rgba4(r, g, b, a) -> np.ndarray:
+    return np.stack(((a >> 4) | (b & 0xF0), (g >> 4) | (r & 0xF0)), axis=-1)
+
+
+def encode_la8(r, g, b, a) -> np.ndarray:
+    return np.stack((a, luminance(r, g, b)), axis=-1)
+
+
+def encode_hilo8(r, g, b, a) -> np.ndarray:
+    return np.stack((g, r), axis=-1)
+
+
+def encode_l8(r, g, b, a) -> np.ndarray:
+    return luminance(r, g, b)
+
+
+def encode_a8(r, g, b, a) -> np.ndarray:
+    return a
+
+
+def encode_la4(r, g, b, a) -> np.ndarray:
+    return (a >> 4) | (luminance(r, g, b) & 0xF0)
+
+
+def encode_l4(r, g, b, a) -> np.ndarray:
+    return pack_nibbles(luminance(r, g, b))
+
+
+def encode_a4(r, g, b, a) -> np.ndarray:
+    return pack_nibbles(a)
+
+
+# each takes the channels of the pixels in output order,
+# and returns an array of them in the target format
+ENCODERS = {
+    TextureFormat.RGBA8: encode_rgba8,
+    TextureFormat.RGB8: encode_rgb8,
+    TextureFormat.RGBA5551: encode_rgba5551,
+    TextureFormat.RGB565: encode_rgb565,
+    TextureFormat.RGBA4: encode_rgba4,
+    TextureFormat.LA8: encode_la8,
+    TextureFormat.HILO8: encode_hilo8,
+    TextureFormat.L8: encode_l8,
+    TextureFormat.A8: encode_a8,
+    TextureFormat.LA4: encode_la4,
+    TextureFormat.L4: encode_l4,
+    TextureFormat.A4: encode_a4,
+}
+
+
+def supported_formats() -> list[TextureFormat]:
+    return [*ENCODERS, TextureFormat.ETC1, TextureFormat.ETC1A4]
+
+
+def swizzle(
+    im: Image,
+    format: TextureFormat,
+    quality: ETC1Quality = ETC1Quality.Medium,
+    workers: int | None = None,
+) -> bytes:
+    if format in (TextureFormat.ETC1, TextureFormat.ETC1A4):
+        pixels = np.frombuffer(im.tobytes(), dtype=np.uint8)
+        pixels = pixels.reshape(im.height, im.width, 4)
+        return etc1.encode(pixels, format == TextureFormat.ETC1A4, quality, workers)
+    if format not in ENCODERS:
+        raise RuntimeError(f"Unsupported pixel format {format.name}")
+    pixels = np.frombuffer(im.tobytes(), dtype=np.uint8).reshape(-1, 4)
+    pixels = pixels[tile_order(im.width, im.height)]
+    encoded = ENCODERS[format](*pixels.T)
+    # multi-byte pixels are little endian
+    return encoded.astype(encoded.dtype.newbyteorder("<")).tobytes()
+
+
+class MipmapFilter(IntEnum):
+    Box = 0
+    Lanczos = 1
+
+
+def downsample_box(im: Image) -> Image:
+    """halves an RGBA image by averaging each 2x2 square"""
+    pixels = np.asarray(im, dtype=np.uint16)
+    pixels = pixels.reshape(im.height // 2, 2, im.width // 2, 2, 4).sum((1, 3))
+    return fromarray(((pixels + 2) >> 2).astype(np.uint8))
+
+
+def mipmap_chain(im: Image, levels: int, filter: MipmapFilter) -> list[Image]:
+    """
+    The image followed by its mipmaps, up to the given number of levels in total,
+    or as many as possible if levels is 0.
+    Levels stop once halving wouldn't leave whole 8x8 tiles.
+    """
+    chain = [im]
+    while (levels == 0 or len(chain) < levels) and (
+        chain[-1].width % 16 == 0 and chain[-1].height % 16 == 0
+    ):
+        if filter == MipmapFilter.Box:
+            chain.append(downsample_box(chain[-1]))
+        else:
+            # resampled from the full image, so errors don't build up between levels
+            size = (chain[-1].width // 2, chain[-1].height // 2)
+            chain.append(im.resize(size, Resampling.LANCZOS))
+    return chain
 
 
 def to_txob(
-    im: Image, format: TextureFormat = TextureFormat.RGBA4, mipmaps=1
+    im: Image,
+    format: TextureFormat = TextureFormat.RGBA4,
+    mipmaps=1,
+    quality: ETC1Quality = ETC1Quality.Medium,
+    workers: int | None = None,
+    mipmap_filter: MipmapFilter = MipmapFilter.Box,
+    preprocess: Callable | None = None,
+    timer: StageTimer | None = None,
 ) -> ImageTexture:
+    """
+    mipmaps is the number of levels including the image itself, 0 for all of them.
+    preprocess is called with the (height, width, 4) pixels of each level and timer,
+    and returns the pixels to store.
+    """
     txob = ImageTexture()
     txob.width = txob.pixel_based_image.width = im.width
     txob.height = txob.pixel_based_image.height = im.height
     im = im.convert("RGBA")
     txob.hw_format = format
-    txob.pixel_based_image.data = swizzle(im, format)
-    txob.mipmap_level_count = 1
+    with timed(timer, "mipmaps"):
+        chain = mipmap_chain(im, mipmaps, mipmap_filter)
+    if preprocess is not None:
+        chain = [fromarray(preprocess(np.asarray(level), timer)) for level in chain]
+    # levels are stored one after another, largest first
+    with timed(timer, "swizzle"):
+        txob.pixel_based_image.data = b"".join(
+            swizzle(level, format, quality, workers) for level in chain
+        )
+    txob.mipmap_level_count = len(chain)
     return txob
@@ -20,19 +20,22 @@ class TextureFormat(IntEnum):
     ETC1 = 12
     ETC1A4 = 13
 
-    def bytes_per_pixel(self):
+    def bits_per_pixel(self) -> int:
         match self:
             case self.RGBA8:
-                return 4
+                return 32
             case self.RGB8:
-                return 3
+                return 24
             case f if f >= self.RGBA5551 and f <= self.HILO8:
-                return 2
-            case self.L8 | self.A8 | self.LA4:
-                return 1
-            case self.L4 | self.A4:
-                return 0.5
-            # TODO ETC1 / ETC1A4
+                return 16
+            case self.L8 | self.A8 | self.LA4 | self.ETC1A4:
+                return 8
+            case self.L4 | self.A4 | self.ETC1:
+                return 4
+
+    def data_size(self, width: int, height: int) -> int:
+        """bytes taken by one image in this format"""
+        return width * height * self.bits_per_pixel() // 8
 
 
 class TXOB(StandardObject):
@@ -0,0 +1,120 @@
+from collections import deque
+import numpy as np
+
+# entries in the post-transform vertex cache that ACMR is measured against
+CACHE_SIZE = 16
+
+# Forsyth's scoring constants
+SCORING_CACHE_SIZE = 32
+CACHE_DECAY_POWER = 1.5
+LAST_TRIANGLE_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+
+def acmr(indices: np.ndarray, cache_size: int = CACHE_SIZE) -> float:
+    """average vertices transformed per triangle, with a FIFO cache of cache_size"""
+    if len(indices) < 3:
+        return 0
+    cache = deque()
+    cached = set()
+    misses = 0
+    for v in indices.tolist():
+        if v in cached:
+            continue
+        misses += 1
+        cache.append(v)
+        cached.add(v)
+        if len(cache) > cache_size:
+            cached.discard(cache.popleft())
+    return misses / (len(indices) // 3)
+
+
+def forsyth(
+    indices: np.ndarray, vertex_count: int, cache_size: int = SCORING_CACHE_SIZE
+) -> np.ndarray:
+    """
+    Reorders triangles for the vertex cache with Tom Forsyth's linear-speed
+    algorithm: the next triangle is always the best scoring one touching the
+    simulated cache, scored on cache position and how many triangles
+    each vertex has left.
+    """
+    triangles = indices.reshape(-1, 3)
+    count = len(triangles)
+    if count < 2:
+        return indices
+    # the triangles using each vertex
+    flat = triangles.reshape(-1)
+    uses = np.bincount(flat, minlength=vertex_count)
+    by_vertex = (np.argsort(flat, kind="stable") // 3).tolist()
+    starts = np.concatenate(([0], np.cumsum(uses))).tolist()
+    adjacent = [by_vertex[starts[v] : starts[v + 1]] for v in range(vertex_count)]
+    live = uses.tolist()
+
+    cache_scores = [LAST_TRIANGLE_SCORE] * 3 + [
+        (1 - (i - 3) / (cache_size - 3)) ** CACHE_DECAY_POWER
+        for i in range(3, cache_size)
+    ]
+    valence_scores = [0.0] + [
+        VALENCE_BOOST_SCALE * n**-VALENCE_BOOST_POWER for n in range(1, max(live) + 1)
+    ]
+    vertex_scores = [valence_scores[n] for n in live]
+    triangle_list = triangles.tolist()
+    triangle_scores = [
+        vertex_scores[a] + vertex_scores[b] + vertex_scores[c]
+        for a, b, c in triangle_list
+    ]
+    emitted = bytearray(count)
+    order = []
+    cache = []
+    best = max(range(count), key=triangle_scores.__getitem__)
+    # where to look for a triangle when nothing in the cache has any left
+    next_unemitted = 0
+
+    for _ in range(count):
+        if best < 0:
+            while emitted[next_unemitted]:
+                next_unemitted += 1
+            best = next_unemitted
+        triangle = triangle_list[best]
+        emitted[best] = 1
+        order.append(best)
+        for v in triangle:
+            adjacent[v].remove(best)
+            live[v] -= 1
+
+        cache = triangle + [v for v in cache if v not in triangle]
+        for v in cache[cache_size:]:
+            vertex_scores[v] = valence_scores[live[v]]
+            for t in adjacent[v]:
+                a, b, c = triangle_list[t]
+                triangle_scores[t] = (
+                    vertex_scores[a] + vertex_scores[b] + vertex_scores[c]
+                )
+        del cache[cache_size:]
+        for i, v in enumerate(cache):
+            n = live[v]
+            vertex_scores[v] = cache_scores[i] + valence_scores[n] if n else 0.0
+
+        best = -1
+        best_score = -1.0
+        for v in cache:
+            for t in adjacent[v]:
+                a, b, c = triangle_list[t]
+                score = vertex_scores[a] + vertex_scores[b] + vertex_scores[c]
+                triangle_scores[t] = score
+                if score > best_score:
+                    best = t
+                    best_score = score
+    return triangles[order].reshape(-1)
+
+
+def first_use_order(indices: np.ndarray, vertex_count: int) -> np.ndarray:
+    """
+    The old index of each vertex once they're numbered in the order the indices
+    first use them. Unused vertices go at the end.
+    """
+    used, first = np.unique(indices, return_index=True)
+    used = used[np.argsort(first, kind="stable")]
+    unused = np.setdiff1d(np.arange(vertex_count), used, assume_unique=True)
+    return np.concatenate((used, unused))
@@ -2,9 +2,25 @@
 
 from cgfx.cgfx import CGFX
 from cgfx.cmdl import CMDL, CMDLWithSkeleton
-from cgfx.shared import StringTable, Vector3, Vector4, Matrix
-from cgfx.dict import DictInfo
-from cgfx.txob import ImageTexture, PixelBasedImage, ReferenceTexture
+from cgfx.shared import (
+    StringTable,
+    BlobTable,
+    BaseObject,
+    DATA_TYPES,
+    Vector3,
+    Vector4,
+    Matrix,
+    List,
+)
+from cgfx.dict import DictInfo, Node
+from cgfx.txob import (
+    TXOB,
+    ImageTexture,
+    PixelBasedImage,
+    ReferenceTexture,
+    TextureFormat,
+)
+from cgfx.etc1 import ETC1Quality
 from cgfx.sobj import (
     SOBJMesh,
     SOBJShape,
@@ -19,6 +35,7 @@ from cgfx.primitives import (
     PrimitiveSet,
     InterleavedVertexStream,
     IndexStream,
+    PrimitiveMode,
     VertexStream,
     VertexAttributeUsage,
     VertexAttributeFlag,
@@ -39,6 +56,7 @@ from cgfx.mtob import (
     ConstantColorSource,
     BumpMode,
     FragmentLightingFlags,
+    TextureProjection,
 )
 from cgfx.animation import (
     GraphicsAnimationGroup,
@@ -59,17 +77,179 @@ from cgfx.canm import (
     Hermite128Key,
     CANMBoneRgbaColor,
 )
+from concurrent.futures import ProcessPoolExecutor
+import copy
 import itertools
+from itertools import repeat
+import json
 import struct
 from cgfx import swizzler
+from cgfx.swizzler import MipmapFilter
+from cgfx.analysis import TextureAnalysis
+from cgfx.preprocess import (
+    NormalMapPreprocessor,
+    StageTimer,
+    invert_channels,
+    timed,
+)
+from cgfx.cache import EncodeCache
+from cgfx.atlas import PAGE_SIZE, build_page, pack
+from cgfx.vcache import CACHE_SIZE, acmr, first_use_order, forsyth
+from cgfx.strips import stripify
+from cgfx import sizes
+from cgfx.sizes import SizeReport
 from PIL import Image
 import gltflib
+import numpy as np
 from io import BytesIO
 import math
 import argparse
+import mmap
 import os.path
 
 
+class ConvertOptions:
+    # None to pick one per texture based on its content
+    texture_format: TextureFormat | None = TextureFormat.RGBA4
+    # lowest acceptable PSNR in dB when picking formats
+    min_psnr = 35.0
+    etc1_quality = ETC1Quality.Medium
+    # processes used for texture encoding, None for one per CPU
+    workers: int | None = None
+    # mipmap levels including the full image, 0 for as many as possible
+    diffuse_mipmaps = 1
+    normal_mipmaps = 1
+    mipmap_filter = MipmapFilter.Box
+    # rescale normal map texels to unit length after filtering
+    renormalize_normals = False
+    # directory of the encoded texture cache, None to disable it
+    cache_dir: str | None = None
+    cache_size = 256 << 20
+    # pack small clamped textures onto shared pages
+    atlas = False
+    # largest error allowed when storing vertex data in smaller types,
+    # None to keep it as it is in the glTF
+    vertex_tolerance: float | None = None
+    # store the vertex attributes of each shape in one buffer
+    interleave = False
+    # reorder triangles and vertices for the vertex cache
+    optimize_indices = False
+    # draw with triangle strips where they take fewer indices than lists
+    strips = False
+
+
+class ConversionReport:
+    """records the choices made during conversion"""
+
+    # texture name -> details
+    textures: dict[str, dict]
+    # texture name -> the texture with the same pixels it was merged into
+    # and the bytes saved
+    merged: dict[str, dict]
+    # pages made by atlas_textures and what's on them
+    atlas: list[dict]
+    # what quantize_shapes did, if it was used
+    vertices: dict | None = None
+    # the ACMR of each shape before and after optimize_indices, if it was used
+    indices: dict | None = None
+    # what stripify_shapes did, if it was used
+    strips: dict | None = None
+    # shape name -> shapes it was split into to fit 16-bit indices
+    split: dict[str, int]
+    # what fit_budget did, if it was used
+    budget: dict | None = None
+
+    def __init__(self) -> None:
+        self.textures = {}
+        self.merged = {}
+        self.atlas = []
+        self.split = {}
+
+    def as_dict(self) -> dict:
+        d = {"textures": self.textures}
+        if self.merged:
+            d["merged"] = self.merged
+        if self.atlas:
+            d["atlas"] = self.atlas
+        if self.split:
+            d["split"] = self.split
+        if self.vertices is not None:
+            d["vertices"] = self.vertices
+        if self.indices is not None:
+            d["indices"] = self.indices
+        if self.strips is not None:
+            d["strips"] = self.strips
+        if self.budget is not None:
+            d["budget"] = self.budget
+        return d
+
+    def format_table(self) -> str:
+        lines = [f"{'texture':<32} {'dims':>9} {'format':<8} {'PSNR':>6} {'ms':>8}"]
+        for name, tex in self.textures.items():
+            psnr = tex.get("psnr", {}).get(tex["format"])
+            timings = tex.get("timings")
+            lines.append(
+                f"{name:<32} {tex['width']:>4}x{tex['height']:<4} {tex['format']:<8} "
+                + (f"{psnr:>6.2f}" if psnr is not None else f"{'-':>6}")
+                + (f" {sum(timings.values()):>8.1f}" if timings else f" {'-':>8}")
+                + ("  cached" if tex.get("cached") else "")
+            )
+        if self.merged:
+            lines.append("")
+            lines.append(
+                f"merged {len(self.merged)} duplicate textures, saving "
+                f"{sum(m['saved'] for m in self.merged.values())} bytes"
+            )
+            for name, merge in self.merged.items():
+                lines.append(f"{name:<32} -> {merge['into']}")
+        for page in self.atlas:
+            lines.append("")
+            lines.append(
+                f"{page['name']} {page['width']}x{page['height']} {page['format']}: "
+                + ", ".join(page["textures"])
+            )
+        if self.split:
+            lines.append("")
+            for name, parts in self.split.items():
+                lines.append(f"split {name} into {parts} shapes for 16-bit indices")
+        if self.vertices is not None:
+            lines.append("")
+            types = ", ".join(f"{n} {t}" for t, n in self.vertices["types"].items())
+            lines.append(
+                f"quantized vertex streams ({types or 'none'}), "
+                f"saving {self.vertices['saved']} bytes"
+            )
+        if self.indices is not None:
+            shapes = self.indices["shapes"].values()
+            triangles = sum(s["triangles"] for s in shapes)
+            if triangles:
+                before = sum(s["triangles"] * s["before"] for s in shapes) / triangles
+                after = sum(s["triangles"] * s["after"] for s in shapes) / triangles
+                lines.append("")
+                lines.append(
+                    f"vertex cache ACMR {before:.3f} -> {after:.3f} "
+                    f"over {triangles} triangles"
+                )
+        if self.strips is not None:
+            lines.append("")
+            lines.append(
+                f"{self.strips['strips']} triangle strips, "
+                f"{self.strips['lists']} triangle lists kept, indices "
+                f"{self.strips['indices_before']} -> {self.strips['indices_after']}"
+            )
+        if self.budget is not None:
+            lines.append("")
+            lines.append(
+                f"size {self.budget['initial_size']} -> {self.budget['final_size']} "
+                f"bytes (budget {self.budget['budget']})"
+            )
+            for lever in self.budget["levers"]:
+                lines.append(
+                    f"{lever['saved']:>8} {lever['lever']:<20} {lever['detail']}"
+                )
+        return "\n".join(lines)
+
+
 def quat_to_euler(x: float, y: float, z: float, w: float) -> Vector3:
     t0 = 2 * (w * x + y * z)
     t1 = 1 - 2 * (x * x + y * y)
@@ -340,24 +520,19 @@ def make_material_animation(material_animation: GraphicsAnimationGroup, mtob: MT
     member.parent_name = mtob.name
 
 
-def gltf_get_bv_data(gltf: gltflib.GLTF, bv_id: int) -> bytes:
+def gltf_get_bv_data(gltf: gltflib.GLTF, bv_id: int) -> memoryview:
     bv = gltf.model.bufferViews[bv_id]
     buf = gltf.model.buffers[bv.buffer]
     if buf.uri is None:
         buf_res = gltf.get_glb_resource()
     else:
         buf_res = gltf.get_resource(buf.uri)
-    byteOffset = bv.byteOffset != None if bv.byteOffset else 0
-    return buf_res.data[byteOffset : byteOffset + bv.byteLength]
+    byteOffset = bv.byteOffset or 0
+    # a view, so vertex data can go into the IMAG block without being copied
+    return memoryview(buf_res.data)[byteOffset : byteOffset + bv.byteLength]
 
-def gltf_get_accessor_data_vertices(
-    gltf: gltflib.GLTF, acc: int | gltflib.Accessor
-) -> list[bytes]:
-    if isinstance(acc, int):
-        acc = gltf.model.accessors[acc]
-    bv = gltf.model.bufferViews[acc.bufferView]
-    bv_data = gltf_get_bv_data(gltf, acc.bufferView)
-    start = acc.byteOffset or 0
+
+def gltf_get_element_size(acc: gltflib.Accessor) -> int:
     component_sizes = {5120: 1, 5121: 1, 5122: 2, 5123: 2, 5125: 4, 5126: 4}
     type_sizes = {
         "SCALAR": 1,
@@ -368,7 +543,18 @@ def gltf_get_accessor_data_vertices(
         "MAT3": 9,
         "MAT4": 16,
     }
-    element_size = component_sizes[acc.componentType] * type_sizes[acc.type]
+    return component_sizes[acc.componentType] * type_sizes[acc.type]
+
+
+def gltf_get_accessor_data_vertices(
+    gltf: gltflib.GLTF, acc: int | gltflib.Accessor
+) -> list[memoryview]:
+    if isinstance(acc, int):
+        acc = gltf.model.accessors[acc]
+    bv = gltf.model.bufferViews[acc.bufferView]
+    bv_data = gltf_get_bv_data(gltf, acc.bufferView)
+    start = acc.byteOffset or 0
+    element_size = gltf_get_element_size(acc)
     stride = bv.byteStride or element_size
     return list(
         bv_data[i : i + element_size]
@@ -376,42 +562,512 @@ def gltf_get_accessor_data_vertices(
     )
 
 
-def gltf_get_accessor_data_raw(gltf: gltflib.GLTF, acc: gltflib.Accessor) -> bytes:
+def gltf_get_accessor_data_raw(
+    gltf: gltflib.GLTF, acc: gltflib.Accessor
+) -> memoryview | bytes:
+    bv = gltf.model.bufferViews[acc.bufferView]
+    element_size = gltf_get_element_size(acc)
+    if (bv.byteStride or element_size) == element_size:
+        # tightly packed, so it can be used in place
+        start = acc.byteOffset or 0
+        return gltf_get_bv_data(gltf, acc.bufferView)[
+            start : start + acc.count * element_size
+        ]
     return b"".join(gltf_get_accessor_data_vertices(gltf, acc))
 
 
-def gltf_get_texture(
-    cgfx: CGFX, gltf: gltflib.GLTF, image_id: int, normal: bool = False
-) -> ImageTexture:
+def map_file_resources(gltf: gltflib.GLTF, basepath: str):
+    """maps unloaded external files into memory instead of reading them in"""
+    for res in gltf.resources:
+        if isinstance(res, gltflib.FileResource) and not res.loaded:
+            with open(os.path.join(basepath, res.filename), "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    res.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    res.data = b""
+
+
+def gltf_texture_name(gltf: gltflib.GLTF, image_id: int, normal: bool) -> str:
     image = gltf.model.images[image_id]
     tex_name = image.name or image.uri or f"image{image_id}"
     if normal:
         tex_name = f"NORM~{tex_name}"
-    if tex_name in cgfx.data.textures:
-        return cgfx.data.textures[tex_name]
+    return tex_name
 
+
+def gltf_get_image_data(gltf: gltflib.GLTF, image_id: int) -> bytes:
+    image = gltf.model.images[image_id]
     if image.uri is not None:
-        image_data = gltf.get_resource(image.uri).data
-    elif image.bufferView is not None:
-        image_data = gltf_get_bv_data(gltf, image.bufferView)
-
-    im: Image.Image = Image.open(BytesIO(image_data))
-    if im.width > 256:
-        im = im.resize((256, im.height))
-    if im.height > 256:
-        im = im.resize((im.width, 256))
+        return bytes(gltf.get_resource(image.uri).data)
+    return bytes(gltf_get_bv_data(gltf, image.bufferView))
+
+
+def texture_image(
+    image_data: bytes, normal: bool, timer: StageTimer | None = None
+) -> Image.Image:
+    """the image as it's going to be stored, other than the format"""
+    with timed(timer, "decode"):
+        im: Image.Image = Image.open(BytesIO(image_data))
+        # opening is lazy
+        im.load()
+        if im.width > 256:
+            im = im.resize((256, im.height))
+        if im.height > 256:
+            im = im.resize((im.width, 256))
     if normal:
-        im = im.convert("RGBA")
-        for x in range(im.width):
-            for y in range(im.height):
-                px = im.getpixel((x, y))
-                im.putpixel((x, y), (255 - px[0], 255 - px[1], px[2]))
-    txob = swizzler.to_txob(im.transpose(Image.Transpose.FLIP_TOP_BOTTOM))
+        with timed(timer, "invert"):
+            im = Image.fromarray(invert_channels(np.asarray(im.convert("RGBA"))))
+    return im
+
+
+def gltf_get_texture_image(
+    gltf: gltflib.GLTF, image_id: int, normal: bool
+) -> Image.Image:
+    return texture_image(gltf_get_image_data(gltf, image_id), normal)
+
+
+def encode_texture(
+    im: Image.Image,
+    format: TextureFormat,
+    normal: bool,
+    options: ConvertOptions,
+    timer: StageTimer | None = None,
+) -> ImageTexture:
+    return swizzler.to_txob(
+        im.transpose(Image.Transpose.FLIP_TOP_BOTTOM),
+        format,
+        options.normal_mipmaps if normal else options.diffuse_mipmaps,
+        quality=options.etc1_quality,
+        workers=options.workers,
+        mipmap_filter=options.mipmap_filter,
+        preprocess=(
+            NormalMapPreprocessor(options.renormalize_normals) if normal else None
+        ),
+        timer=timer,
+    )
+
+
+def texture_cache_key(image_data: bytes, normal: bool, options: ConvertOptions) -> str:
+    format = options.texture_format
+    return EncodeCache.key(
+        image_data,
+        "auto" if format is None else format.name,
+        options.min_psnr if format is None else None,
+        normal,
+        options.normal_mipmaps if normal else options.diffuse_mipmaps,
+        options.etc1_quality.name,
+        options.mipmap_filter.name,
+        normal and options.renormalize_normals,
+    )
+
+
+def pack_cached_texture(txob: ImageTexture, details: dict) -> bytes:
+    # a JSON header followed by the image data
+    # timings are only true for the run that did the work
+    details = {k: v for k, v in details.items() if k != "timings"}
+    header = json.dumps(
+        {"details": details, "mipmaps": txob.mipmap_level_count}
+    ).encode()
+    return struct.pack("<I", len(header)) + header + txob.pixel_based_image.data
+
+
+def unpack_cached_texture(data: bytes) -> tuple[ImageTexture, dict]:
+    """raises ValueError if the entry isn't one written by pack_cached_texture"""
+    try:
+        (size,) = struct.unpack_from("<I", data)
+        header = json.loads(data[4 : 4 + size])
+        details = header["details"]
+        txob = ImageTexture()
+        txob.width = txob.pixel_based_image.width = details["width"]
+        txob.height = txob.pixel_based_image.height = details["height"]
+        txob.hw_format = TextureFormat[details["format"]]
+        txob.mipmap_level_count = header["mipmaps"]
+        expected = sum(
+            txob.hw_format.data_size(txob.width >> i, txob.height >> i)
+            for i in range(txob.mipmap_level_count)
+        )
+    except (struct.error, ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"malformed texture cache entry: {e!r}") from e
+    txob.pixel_based_image.data = data[4 + size :]
+    if len(txob.pixel_based_image.data) != expected:
+        raise ValueError("malformed texture cache entry: wrong image data size")
+    return txob, details
+
+
+def convert_texture(
+    image_data: bytes, normal: bool, options: ConvertOptions
+) -> tuple[ImageTexture, dict]:
+    """decodes and encodes a texture, returning it and the details for the report"""
+    timer = StageTimer()
+    im = texture_image(image_data, normal, timer)
+    format = options.texture_format
+    details = {"width": im.width, "height": im.height}
+    if format is None:
+        with timer.stage("analysis"):
+            analysis = TextureAnalysis(im, options.min_psnr, normal)
+        format = analysis.format
+        details.update(analysis.as_dict())
+    elif normal and format == TextureFormat.LA8:
+        # LA8 is sampled as (L, L, L, A), which loses Y
+        format = TextureFormat.HILO8
+    details["format"] = format.name
+    txob = encode_texture(im, format, normal, options, timer)
+    details["timings"] = timer.as_dict()
+    return txob, details
+
+
+def texture_cache(options: ConvertOptions) -> EncodeCache | None:
+    if options.cache_dir is None:
+        return None
+    return EncodeCache(options.cache_dir, options.cache_size)
+
+
+def cached_texture(
+    cache: EncodeCache | None, key: str | None
+) -> tuple[ImageTexture, dict] | None:
+    entry = cache.get(key) if cache is not None else None
+    if entry is None:
+        return None
+    try:
+        txob, details = unpack_cached_texture(entry)
+    except ValueError as e:
+        # treated as a miss, so the entry is written again
+        print(f"WARNING: ignoring texture cache entry {key}: {e}")
+        return None
+    details["cached"] = True
+    return txob, details
+
+
+def used_textures(gltf: gltflib.GLTF) -> list[tuple[int, bool]]:
+    """(image id, normal) of every texture used by a mesh, in order of first use"""
+    used = {}
+    for mesh in gltf.model.meshes or []:
+        for primitive in mesh.primitives:
+            if primitive.material is None:
+                continue
+            material = gltf.model.materials[primitive.material]
+            pmr = material.pbrMetallicRoughness
+            if pmr and pmr.baseColorTexture:
+                tex = gltf.model.textures[pmr.baseColorTexture.index]
+                used[(tex.source, False)] = None
+            if material.normalTexture:
+                tex = gltf.model.textures[material.normalTexture.index]
+                used[(tex.source, True)] = None
+    return list(used)
+
+
+def encode_textures(
+    gltf: gltflib.GLTF, options: ConvertOptions
+) -> dict[tuple[int, bool], tuple[ImageTexture, dict]]:
+    """
+    Converts every texture used by a mesh up front, over options.workers processes.
+    Results are keyed by (image id, normal) for gltf_get_texture to pick up,
+    so textures are still added in the order materials use them.
+    """
+    cache = texture_cache(options)
+    encoded = {}
+    # (image id, normal), image data, cache key
+    todo = []
+    # (image data, normal) -> the first texture made from it
+    sources = {}
+    # textures with the same source as an earlier one
+    copies = {}
+    for image_id, normal in used_textures(gltf):
+        image_data = gltf_get_image_data(gltf, image_id)
+        if (image_data, normal) in sources:
+            copies[(image_id, normal)] = sources[(image_data, normal)]
+            continue
+        sources[(image_data, normal)] = (image_id, normal)
+        key = texture_cache_key(image_data, normal, options) if cache else None
+        result = cached_texture(cache, key)
+        if result is not None:
+            encoded[(image_id, normal)] = result
+        else:
+            todo.append(((image_id, normal), image_data, key))
+
+    if len(todo) > 1 and options.workers != 1:
+        # each texture gets one process, rather than ETC1 starting its own
+        texture_options = copy.copy(options)
+        texture_options.workers = 1
+        with ProcessPoolExecutor(options.workers) as pool:
+            results = list(
+                pool.map(
+                    convert_texture,
+                    [image_data for _, image_data, _ in todo],
+                    [normal for (_, normal), _, _ in todo],
+                    repeat(texture_options),
+                )
+            )
+    else:
+        results = [
+            convert_texture(image_data, normal, options)
+            for (_, normal), image_data, _ in todo
+        ]
+    for (texture, _, key), result in zip(todo, results):
+        encoded[texture] = result
+        if cache is not None:
+            cache.put(key, pack_cached_texture(*result))
+    if cache is not None and todo:
+        cache.evict()
+    for texture, source in copies.items():
+        encoded[texture] = encoded[source]
+    return encoded
+
+
+def texture_key(txob: ImageTexture) -> tuple:
+    """identifies a texture by its encoded pixels"""
+    return (
+        txob.hw_format,
+        txob.width,
+        txob.height,
+        txob.mipmap_level_count,
+        BlobTable.digest(memoryview(txob.pixel_based_image.data).cast("B")),
+    )
+
+
+def texture_entry_size(name: str) -> int:
+    """
+    Bytes taken by a texture besides its IMAG data, which BlobTable shares anyway:
+    its objects, DICT node and name
+    """
+    return (
+        ImageTexture.struct.size
+        + PixelBasedImage.struct.size
+        + Node.struct.size
+        + len(name.encode())
+        + 1
+    )
+
+
+def gltf_get_texture(
+    cgfx: CGFX,
+    gltf: gltflib.GLTF,
+    image_id: int,
+    normal: bool = False,
+    options: ConvertOptions | None = None,
+    report: ConversionReport | None = None,
+    encoded: dict[tuple[int, bool], tuple[ImageTexture, dict]] | None = None,
+    by_key: dict[tuple, ImageTexture] | None = None,
+) -> ImageTexture:
+    """
+    encoded is the result of encode_textures, if it was run.
+    by_key is the texture_key of every texture in cgfx, kept up to date
+    between calls, built from the textures if it isn't given.
+    """
+    if options is None:
+        options = ConvertOptions()
+    tex_name = gltf_texture_name(gltf, image_id, normal)
+    if tex_name in cgfx.data.textures:
+        return cgfx.data.textures[tex_name]
+
+    if encoded and (image_id, normal) in encoded:
+        txob, details = encoded[(image_id, normal)]
+    else:
+        image_data = gltf_get_image_data(gltf, image_id)
+        cache = texture_cache(options)
+        key = texture_cache_key(image_data, normal, options) if cache else None
+        result = cached_texture(cache, key)
+        if result is None:
+            result = convert_texture(image_data, normal, options)
+            if cache is not None:
+                cache.put(key, pack_cached_texture(*result))
+                cache.evict()
+        txob, details = result
+    if by_key is None:
+        by_key = {
+            texture_key(cgfx.data.textures[name]): cgfx.data.textures[name]
+            for name in cgfx.data.textures
+        }
+    # different images with the same pixels end up as one texture
+    key = texture_key(txob)
+    original = by_key.get(key)
+    if original is not None:
+        if report is not None:
+            report.merged[tex_name] = {
+                "into": original.name,
+                "saved": texture_entry_size(tex_name),
+            }
+        return original
+    if report is not None:
+        report.textures[tex_name] = details
     txob.name = tex_name
     cgfx.data.textures.add(tex_name, txob)
+    by_key[key] = txob
     return txob
 
 
+# glTF min filter -> TextureSampler.min_filter
+MIN_FILTERS = {9728: 0, 9729: 1, 9984: 2, 9986: 3, 9985: 4, 9987: 5}
+
+
+def sampler_min_filter(txob: ImageTexture, gltf_filter: int | None) -> int:
+    if txob.mipmap_level_count <= 1:
+        return 0
+    if gltf_filter in (None, 9728, 9729):
+        # blend between levels, keeping the filter within a level
+        return 5 if (gltf_filter or 9729) == 9729 else 3
+    return MIN_FILTERS[gltf_filter]
+
+
+# numpy types of vertex stream data
+STREAM_DTYPES = {
+    DataType.Byte: "<i1",
+    DataType.UByte: "<u1",
+    DataType.Short: "<i2",
+    DataType.Float: "<f4",
+}
+
+
+def texture_mappings(cgfx: CGFX) -> dict[int, tuple[TXOB, list]]:
+    """
+    id of each texture used by a material ->
+    the texture and the (material, mapper index, shapes drawn with it) of each use
+    """
+    mappings = {}
+    for model_name in cgfx.data.models:
+        cmdl = cgfx.data.models[model_name]
+        shapes = {}
+        for mesh in cmdl.meshes.data.contents:
+            shapes.setdefault(mesh.material_index, []).append(
+                cmdl.shapes.data.contents[mesh.shape_index]
+            )
+        for i, material_name in enumerate(cmdl.materials):
+            mtob = cmdl.materials[material_name]
+            for j, mapper in enumerate(mtob.texture_mappers):
+                if mapper is None:
+                    continue
+                txob = mapper.txob.txob
+                mappings.setdefault(id(txob), (txob, []))[1].append(
+                    (mtob, j, shapes.get(i, []))
+                )
+    return mappings
+
+
+def sampled_in_range(mtob: MTOB, index: int, shapes: list[SOBJShape]) -> bool:
+    """whether a texture mapper only ever samples its texture inside [0, 1], clamped"""
+    mapper = mtob.texture_mappers[index]
+    coordinator = mtob.texture_coordinators[index]
+    head = mapper.commands[2].head
+    # both wrap modes have to be clamp to edge
+    if (head >> 12) & 7 or (head >> 8) & 7:
+        return False
+    if coordinator.projection != TextureProjection.UVMap:
+        return False
+    usage = VertexAttributeUsage.TextureCoordinate0 + coordinator.source_coordinate
+    rows = [[c.x, c.y, c.z, c.w] for c in coordinator.transform_matrix.columns[:2]]
+    for shape in shapes:
+        streams = [
+            vs
+            for vs in shape.vertex_attributes.data.contents
+            if isinstance(vs, VertexStream) and vs.usage == usage
+        ]
+        if not streams or streams[0].format_type not in STREAM_DTYPES:
+            return False
+        vs = streams[0]
+        uv = np.frombuffer(vs.vertex_stream_data, dtype=STREAM_DTYPES[vs.format_type])
+        uv = uv.reshape(-1, vs.components_count)[:, :2] * vs.scale
+        uv = uv @ np.array(rows)[:, :2].T + np.array(rows)[:, 3]
+        if len(uv) and (uv.min() < -1e-4 or uv.max() > 1 + 1e-4):
+            return False
+    return True
+
+
+def atlas_texture_name(cgfx: CGFX) -> str:
+    n = 0
+    while f"Atlas{n}" in cgfx.data.textures:
+        n += 1
+    return f"Atlas{n}"
+
+
+def atlas_textures(cgfx: CGFX, report: ConversionReport | None = None) -> int:
+    """
+    Packs textures that are only sampled inside [0, 1] with clamping onto shared
+    pages of the same format, pointing their texture coordinators at their place
+    on the page. Pages that would make the file bigger are left out.
+    Returns how many textures were packed.
+    """
+    mappings = texture_mappings(cgfx)
+    # format -> textures that can go on a page
+    groups = {}
+    for txob, uses in mappings.values():
+        if (
+            isinstance(txob, ImageTexture)
+            and txob.mipmap_level_count == 1
+            and txob.width % 8 == 0
+            and txob.height % 8 == 0
+            # larger textures leave too little room to share a page
+            and max(txob.width, txob.height) <= PAGE_SIZE // 2
+            and all(sampled_in_range(*use) for use in uses)
+        ):
+            groups.setdefault(txob.hw_format, []).append(txob)
+
+    # id of each packed texture
+    packed = set()
+    for format, textures in groups.items():
+        for page in pack([(t.width, t.height) for t in textures]):
+            if len(page.placements) < 2:
+                continue
+            atlas = build_page(textures, page, format)
+            atlas.name = atlas_texture_name(cgfx)
+            members = [textures[index] for index, _, _ in page.placements]
+            before = sum(
+                len(t.pixel_based_image.data) + texture_entry_size(t.name)
+                for t in members
+            )
+            after = len(atlas.pixel_based_image.data) + texture_entry_size(atlas.name)
+            if after > before:
+                continue
+            cgfx.data.textures.add(atlas.name, atlas)
+            for index, x, y in page.placements:
+                txob = textures[index]
+                packed.add(id(txob))
+                # half a texel in from each edge, so filtering never reaches
+                # the neighbouring textures
+                scale_u = (txob.width - 1) / atlas.width
+                scale_v = (txob.height - 1) / atlas.height
+                translate_u = (x + 0.5) / atlas.width
+                translate_v = (y + 0.5) / atlas.height
+                for mtob, j, _ in mappings[id(txob)][1]:
+                    mtob.texture_mappers[j].txob = ReferenceTexture(atlas)
+                    u, v = mtob.texture_coordinators[j].transform_matrix.columns[:2]
+                    u.x, u.y, u.z = u.x * scale_u, u.y * scale_u, u.z * scale_u
+                    u.w = u.w * scale_u + translate_u
+                    v.x, v.y, v.z = v.x * scale_v, v.y * scale_v, v.z * scale_v
+                    v.w = v.w * scale_v + translate_v
+            if report is not None:
+                report.atlas.append(
+                    {
+                        "name": atlas.name,
+                        "format": format.name,
+                        "width": atlas.width,
+                        "height": atlas.height,
+                        "textures": [t.name for t in members],
+                    }
+                )
+
+    if packed:
+        textures = DictInfo()
+        for name in cgfx.data.textures:
+            txob = cgfx.data.textures[name]
+            if id(txob) not in packed:
+                textures.add(name, txob)
+        cgfx.data.textures = textures
+    return len(packed)
+
+
+def mesh_visibility_member(i: int) -> AnimationGroupMember:
+    """the member of the visibility animation group for the mesh at index i"""
+    mesh_is_visible = AnimationGroupMember()
+    mesh_is_visible.object_type = AnimationGroupMemberType.Mesh
+    mesh_is_visible.path = f"Meshes[{i}].IsVisible"
+    mesh_is_visible.member = str(i)
+    mesh_is_visible.value_offset = 36
+    mesh_is_visible.value_size = 1
+    mesh_is_visible.field_type = 7
+    mesh_is_visible.parent_index = i
+    return mesh_is_visible
+
+
 def make_bones(
     gltf: gltflib.GLTF, node_ids: list[int], bone_dict: DictInfo[Bone]
 ) -> list[Bone]:
@@ -487,11 +1143,20 @@ def make_bones(
     return bones
 
 
-def convert_gltf(gltf: gltflib.GLTF) -> CGFX:
+def convert_gltf(
+    gltf: gltflib.GLTF,
+    options: ConvertOptions | None = None,
+    report: ConversionReport | None = None,
+) -> CGFX:
+    if options is None:
+        options = ConvertOptions()
     default_sampler = gltflib.Sampler(
         magFilter=9729, minFilter=9729, wrapS=10497, wrapT=10497
     )
     default_material = gltflib.Material(name="glTF default material")
+    encoded = encode_textures(gltf, options)
+    # texture_key -> texture, for merging textures with the same pixels
+    by_key = {}
 
     cgfx = CGFX()
 
@@ -529,9 +1194,7 @@ def convert_gltf(gltf: gltflib.GLTF) -> CGFX:
             and gltf.model.materials[p.material].alphaMode == "BLEND"
         ) / len(mesh.primitives)
 
-    cmdl.skeleton.bones.dict.nodes[2:] = sorted(
-        cmdl.skeleton.bones.dict.nodes[2:], key=sort_key
-    )
+    cmdl.skeleton.bones.dict.sort(sort_key, start=1)
 
     # clean up joint ids
     node_to_bone = {}
@@ -696,10 +1359,12 @@ def convert_gltf(gltf: gltflib.GLTF) -> CGFX:
                         if tex.sampler is not None
                         else default_sampler
                     )
-                    tex_info = TexInfo(
-                        ReferenceTexture(
-                            gltf_get_texture(cgfx, gltf, tex.source, False)
-                        )
+                    txob = gltf_get_texture(
+                        cgfx, gltf, tex.source, False, options, report, encoded, by_key
+                    )
+                    tex_info = TexInfo(ReferenceTexture(txob))
+                    tex_info.sampler.min_filter = sampler_min_filter(
+                        txob, sampler.minFilter
                     )
                     tex_param = 0
                     tex_param |= 1 * ((sampler.magFilter or 9729) & 1)
@@ -727,8 +1392,12 @@ def convert_gltf(gltf: gltflib.GLTF) -> CGFX:
                         if tex.sampler is not None
                         else default_sampler
                     )
-                    tex_info = TexInfo(
-                        ReferenceTexture(gltf_get_texture(cgfx, gltf, tex.source, True))
+                    txob = gltf_get_texture(
+                        cgfx, gltf, tex.source, True, options, report, encoded, by_key
+                    )
+                    tex_info = TexInfo(ReferenceTexture(txob))
+                    tex_info.sampler.min_filter = sampler_min_filter(
+                        txob, sampler.minFilter
                     )
                     tex_info.commands[0].head += 8 * mtob.used_texture_coordinates_count
                     tex_info.commands[
@@ -791,18 +1460,21 @@ def convert_gltf(gltf: gltflib.GLTF) -> CGFX:
                 index_stream.face_data = gltf_get_accessor_data_raw(gltf, indices)
                 if material.doubleSided:
                     # duplicate all vertices backwards
-                    rev = reversed(gltf_get_accessor_data_vertices(gltf, indices))
                     acc_id = list(
                         v for k, v in p.attributes.__dict__.items() if v is not None
                     )[0]
-                    count = len(
-                        gltf_get_accessor_data_vertices(
-                            gltf, gltf.model.accessors[acc_id]
-                        )
+                    count = gltf.model.accessors[acc_id].count
+                    front = np.frombuffer(
+                        index_stream.face_data,
+                        dtype=INDEX_DTYPES[indices.componentType],
+                    )
+                    # fit_index_streams picks the real width afterwards
+                    index_stream.data_type = 5125
+                    index_stream.face_data = (
+                        np.concatenate((front, front[::-1].astype(np.uint32) + count))
+                        .astype("<u4")
+                        .tobytes()
                     )
-                    for b in rev:
-                        x = int.from_bytes(b, "little") + count
-                        index_stream.face_data += (x).to_bytes(int(math.log(x,2)/8+1), "little")
                 primitive.index_streams.add(index_stream)
                 primitive.buffer_objects.add(0)
             for ty, acc_id in p.attributes.__dict__.items():
@@ -846,10 +1518,18 @@ def convert_gltf(gltf: gltflib.GLTF) -> CGFX:
                     # duplicate all vertices but with the normals reversed
                     verts = vs.vertex_stream_data
                     if ty != "NORMAL":
-                        vs.vertex_stream_data += verts
+                        vs.vertex_stream_data = b"".join((verts, verts))
                     else:
-                        vs.vertex_stream_data += bytes(
-                            [v ^ (0x80 * (i % 4 == 3)) for i, v in enumerate(verts)]
+                        vs.vertex_stream_data = b"".join(
+                            (
+                                verts,
+                                bytes(
+                                    [
+                                        v ^ (0x80 * (i % 4 == 3))
+                                        for i, v in enumerate(verts)
+                                    ]
+                                ),
+                            )
                         )
 
     visibility_animation = GraphicsAnimationGroup()
@@ -868,15 +1548,9 @@ def convert_gltf(gltf: gltflib.GLTF) -> CGFX:
     is_visible.value_index = 1
 
     for i in range(len(cmdl.meshes)):
-        mesh_is_visible = AnimationGroupMember()
-        visibility_animation.members.add(f"Meshes[{i}].IsVisible", mesh_is_visible)
-        mesh_is_visible.object_type = AnimationGroupMemberType.Mesh
-        mesh_is_visible.path = f"Meshes[{i}].IsVisible"
-        mesh_is_visible.member = str(i)
-        mesh_is_visible.value_offset = 36
-        mesh_is_visible.value_size = 1
-        mesh_is_visible.field_type = 7
-        mesh_is_visible.parent_index = i
+        visibility_animation.members.add(
+            f"Meshes[{i}].IsVisible", mesh_visibility_member(i)
+        )
 
     skeletal_animation = GraphicsAnimationGroup()
     cmdl.animation_group_descriptions.add("SkeletalAnimation", skeletal_animation)
@@ -1469,12 +2143,28 @@ def convert_gltf(gltf: gltflib.GLTF) -> CGFX:
     # member.unknown = 4
     # member.field_type = 12
 
+    fit_index_streams(cgfx, report)
+    if options.atlas:
+        atlas_textures(cgfx, report)
+    if options.vertex_tolerance is not None:
+        quantize_shapes(cgfx, options.vertex_tolerance, report)
+    if options.optimize_indices:
+        optimize_indices(cgfx, report)
+    if options.strips:
+        stripify_shapes(cgfx, report)
+    if options.interleave:
+        interleave_shapes(cgfx)
     return cgfx
 
 
-def write(cgfx: CGFX) -> bytes:
+# the largest CGFX the home menu will load
+MAX_SIZE = 0x80000
+
+
+def prepare(cgfx: CGFX, warn: bool = True) -> tuple[StringTable, BlobTable]:
+    """lays out the whole file, returns the string and IMAG tables"""
     strings = StringTable()
-    imag = StringTable()
+    imag = BlobTable()
     offset = cgfx.prepare(0, strings, imag)
     offset = strings.prepare(offset)
     cgfx.data.section_size = offset - cgfx.data.offset
@@ -1483,29 +2173,984 @@ def write(cgfx: CGFX) -> bytes:
         offset += 8  # IMAG header
     offset = imag.prepare(offset)
     cgfx.header.file_size = offset
-    data = cgfx.write(strings, imag)
-    data += strings.write()
+    if warn and offset > MAX_SIZE:
+        print(f"WARNING: CGFX is too big ({offset} bytes, max is {MAX_SIZE} bytes)")
+    return strings, imag
+
+
+def estimate_size(cgfx: CGFX) -> dict[str, int]:
+    """
+    The exact size of the file and its parts, from the layout pass alone.
+    Nothing is packed, and IMAG data is only hashed to find duplicates.
+    """
+    strings, imag = prepare(cgfx, warn=False)
+    end_of_strings = strings.offset + strings.size()
+    return {
+        "header": cgfx.data.offset,
+        "data": strings.offset - cgfx.data.offset,
+        "strings": strings.size(),
+        # includes its header and the padding before it
+        "imag": cgfx.header.file_size - end_of_strings,
+        "total": cgfx.header.file_size,
+    }
+
+
+def size_report(cgfx: CGFX) -> SizeReport:
+    """what every object in the file takes up, without writing it"""
+    strings, imag = prepare(cgfx, warn=False)
+    return sizes.attribute(cgfx, strings, imag)
+
+
+def imag_header(imag: BlobTable) -> bytes:
+    return b"IMAG" + imag.size().to_bytes(4, "little")
+
+
+def write(cgfx: CGFX, buffer=None) -> bytearray:
+    """buffer may be any writable buffer at least file_size bytes long"""
+    strings, imag = prepare(cgfx)
+    if buffer is None:
+        buffer = bytearray(cgfx.header.file_size)
+    cgfx.write_into(buffer, strings, imag)
+    strings.write_into(buffer)
+    if not imag.empty():
+        buffer[imag.offset - 8 : imag.offset] = imag_header(imag)
+        imag.write_into(buffer)
+    return buffer
+
+
+def write_to(cgfx: CGFX, fp) -> int:
+    """streams the file to a binary file-like object without seeking, returns its size"""
+    strings, imag = prepare(cgfx)
+    cgfx.write_to(fp, strings, imag)
+    strings.write_to(fp)
     if not imag.empty():
-        data += b"IMAG" + imag.size().to_bytes(4, "little") + imag.write()
-    if len(data) > 0x80000:
-        print(f"WARNING: CGFX is too big ({len(data)} bytes, max is {0x80000} bytes)")
-    return data
+        fp.write(imag_header(imag))
+        imag.write_to(fp)
+    return cgfx.header.file_size
+
+
+def walk(obj: BaseObject):
+    """obj and everything it points to, as laid out by the last prepare()"""
+    yield obj
+    for child in obj.layout.children:
+        yield from walk(child)
+
+
+def size_contributions(cgfx: CGFX) -> dict[str, int]:
+    """roughly how many bytes of the laid out file each kind of reducible data takes"""
+    totals = {"textures": 0, "vertex streams": 0, "animation curves": 0}
+    for obj in walk(cgfx):
+        if isinstance(obj, (TXOB, PixelBasedImage)):
+            kind = "textures"
+        elif isinstance(obj, (VertexStream, InterleavedVertexStream)):
+            kind = "vertex streams"
+        elif isinstance(obj, (FloatAnimationCurve, FloatSegment)):
+            kind = "animation curves"
+        else:
+            continue
+        totals[kind] += obj.struct.size
+        for v in obj.layout.values:
+            if isinstance(v, DATA_TYPES):
+                # padded like in the IMAG block
+                n = memoryview(v).nbytes
+                totals[kind] += n + -n % 16
+    return totals
+
+
+# what each integer type can hold, kept symmetric for the signed ones
+TYPE_RANGES = {
+    DataType.UByte: (0, 255),
+    DataType.Byte: (-127, 127),
+    DataType.Short: (-32767, 32767),
+}
+
+
+def quantize_values(
+    values: np.ndarray, data_type: DataType
+) -> tuple[np.ndarray, float]:
+    """values as data_type, and the scale restoring their range"""
+    low, high = TYPE_RANGES[data_type]
+    peak = float(np.abs(values).max()) if values.size else 0
+    # the scale is stored as a float
+    scale = float(np.float32(peak / high)) if peak else 1
+    quantized = np.clip(np.rint(values / scale), low, high)
+    return quantized.astype(STREAM_DTYPES[data_type]), scale
+
+
+def quantize_vertex_stream(vs: VertexStream, data_type: DataType):
+    """converts a float stream to data_type, with the stream's scale restoring the range"""
+    values = np.frombuffer(vs.vertex_stream_data, dtype="<f4")
+    quantized, vs.scale = quantize_values(values, data_type)
+    vs.vertex_stream_data = quantized.tobytes()
+    vs.format_type = data_type
+
+
+def smallest_vertex_type(values: np.ndarray, tolerance: float) -> DataType:
+    """the smallest type holding values to within tolerance, Float if none do"""
+    if not values.size:
+        return DataType.UByte
+    small = DataType.UByte if values.min() >= 0 else DataType.Byte
+    for data_type in (small, DataType.Short):
+        quantized, scale = quantize_values(values, data_type)
+        if np.abs(quantized * scale - values).max() <= tolerance:
+            return data_type
+    return DataType.Float
+
+
+def quantize_shape(shape: SOBJShape, tolerance: float) -> list[VertexStream]:
+    """
+    Stores each float stream of the shape in the smallest type keeping it within
+    tolerance of the original. Positions are centred with position_offset first,
+    so models away from the origin don't waste range.
+    Returns the streams that were changed.
+    """
+    changed = []
+    for vs in shape.vertex_attributes.data.contents:
+        if (
+            not isinstance(vs, VertexStream)
+            or vs.format_type != DataType.Float
+            or vs.usage == VertexAttributeUsage.BoneIndex
+        ):
+            continue
+        values = np.frombuffer(vs.vertex_stream_data, dtype="<f4")
+        values = values.reshape(-1, vs.components_count)
+        center = None
+        if vs.usage == VertexAttributeUsage.Position and len(values):
+            center = (values.min(0) + values.max(0)) / 2
+            values = values - center
+        data_type = smallest_vertex_type(values, tolerance)
+        if data_type == DataType.Float:
+            continue
+        if center is not None:
+            offset = shape.position_offset
+            center = [*center.tolist(), 0, 0][:3]
+            shape.position_offset = Vector3(
+                offset.x + center[0], offset.y + center[1], offset.z + center[2]
+            )
+            vs.vertex_stream_data = values.astype("<f4").tobytes()
+        quantize_vertex_stream(vs, data_type)
+        changed.append(vs)
+    return changed
+
+
+def quantize_shapes(
+    cgfx: CGFX, tolerance: float, report: ConversionReport | None = None
+) -> int:
+    """quantize_shape on every shape, returning the bytes saved"""
+    saved = 0
+    # type name -> streams stored as it
+    types = {}
+    for model_name in cgfx.data.models:
+        for shape in cgfx.data.models[model_name].shapes.data.contents:
+            before = {
+                id(vs): len(vs.vertex_stream_data)
+                for vs in shape.vertex_attributes.data.contents
+                if isinstance(vs, VertexStream)
+            }
+            for vs in quantize_shape(shape, tolerance):
+                saved += before[id(vs)] - len(vs.vertex_stream_data)
+                name = DataType(vs.format_type).name
+                types[name] = types.get(name, 0) + 1
+    if report is not None:
+        report.vertices = {"tolerance": tolerance, "types": types, "saved": saved}
+    return saved
+
+
+# bytes per component of each type
+TYPE_SIZES = {
+    DataType.Byte: 1,
+    DataType.UByte: 1,
+    DataType.Short: 2,
+    DataType.Float: 4,
+}
+
+
+def interleave_shape(shape: SOBJShape) -> bool:
+    """
+    Replaces the separate vertex streams of a shape with one interleaved buffer.
+    Attributes are ordered by component size so each is aligned to it,
+    and vertices are aligned to the largest. Returns whether anything changed.
+    """
+    attributes = shape.vertex_attributes.data.contents
+    streams = [vs for vs in attributes if isinstance(vs, VertexStream)]
+    if len(streams) < 2:
+        return False
+    counts = {
+        len(vs.vertex_stream_data) // (TYPE_SIZES[vs.format_type] * vs.components_count)
+        for vs in streams
+    }
+    if len(counts) != 1:
+        return False
+    (count,) = counts
+
+    streams.sort(key=lambda vs: -TYPE_SIZES[vs.format_type])
+    offsets = []
+    offset = 0
+    for vs in streams:
+        offsets.append(offset)
+        offset += TYPE_SIZES[vs.format_type] * vs.components_count
+    alignment = TYPE_SIZES[streams[0].format_type]
+    stride = -(-offset // alignment) * alignment
+    layout = np.dtype(
+        {
+            "names": [f"a{i}" for i in range(len(streams))],
+            "formats": [
+                (STREAM_DTYPES[vs.format_type], (vs.components_count,))
+                for vs in streams
+            ],
+            "offsets": offsets,
+            "itemsize": stride,
+        }
+    )
+    vertices = np.zeros(count, dtype=layout)
+    for i, vs in enumerate(streams):
+        vertices[f"a{i}"] = np.frombuffer(
+            vs.vertex_stream_data, dtype=STREAM_DTYPES[vs.format_type]
+        ).reshape(count, vs.components_count)
+
+    interleaved = InterleavedVertexStream()
+    interleaved.usage = VertexAttributeUsage.Interlave
+    interleaved.vertex_stream_data = vertices.tobytes()
+    interleaved.vertex_data_entry_size = stride
+    for vs, offset in zip(streams, offsets):
+        vs.vert_offset = offset
+        vs.vertex_stream_data = b""
+        interleaved.vertex_streams.add(vs)
+    shape.vertex_attributes = List(
+        [interleaved] + [a for a in attributes if not isinstance(a, VertexStream)]
+    )
+    return True
+
+
+def interleave_shapes(cgfx: CGFX) -> int:
+    """interleave_shape on every shape, returning how many were changed"""
+    changed = 0
+    for model_name in cgfx.data.models:
+        for shape in cgfx.data.models[model_name].shapes.data.contents:
+            changed += interleave_shape(shape)
+    return changed
+
+
+# numpy types of the index formats glTF allows, the PICA only reads the first two
+INDEX_DTYPES = {DataType.UByte: "u1", DataType.UShort: "<u2", 5125: "<u4"}
+# vertices each index type can reach
+INDEX_LIMITS = {DataType.UByte: 0x100, DataType.UShort: 0x10000}
+
+
+def shape_vertex_rows(shape: SOBJShape) -> tuple[list, int] | None:
+    """
+    The attributes of a shape with their own vertex data, and how many vertices
+    they hold. None if the count can't be worked out or they disagree.
+    """
+    rows = []
+    counts = set()
+    for attribute in shape.vertex_attributes.data.contents:
+        if isinstance(attribute, InterleavedVertexStream):
+            size = attribute.vertex_data_entry_size
+        elif isinstance(attribute, VertexStream):
+            if attribute.format_type not in TYPE_SIZES:
+                return None
+            size = TYPE_SIZES[attribute.format_type] * attribute.components_count
+        else:
+            continue
+        data = attribute.vertex_stream_data
+        if not size or len(data) % size:
+            return None
+        rows.append((attribute, size))
+        counts.add(len(data) // size)
+    if len(counts) != 1:
+        return None
+    return rows, counts.pop()
+
+
+def decode_indices(stream: IndexStream, vertex_count: int) -> np.ndarray | None:
+    """the indices of a triangle list, None if it isn't one or they're invalid"""
+    dtype = INDEX_DTYPES.get(stream.data_type)
+    data = stream.face_data
+    if (
+        dtype is None
+        or stream.primitive_mode != PrimitiveMode.Triangles
+        or len(data) % np.dtype(dtype).itemsize
+    ):
+        return None
+    indices = np.frombuffer(data, dtype=dtype)
+    if len(indices) % 3 or (len(indices) and indices.max() >= vertex_count):
+        return None
+    return indices.astype(np.int64)
+
+
+def split_triangles(indices: np.ndarray, limit: int) -> list[np.ndarray]:
+    """splits a triangle list into consecutive runs each using at most limit vertices"""
+    triangles = indices.reshape(-1, 3)
+    runs = []
+    start = 0
+    while start < len(triangles):
+        rest = triangles[start:].reshape(-1)
+        _, first = np.unique(rest, return_index=True)
+        new = np.zeros(len(rest), dtype=bool)
+        new[first] = True
+        # vertices used by the run ending at each triangle
+        used = np.cumsum(new.reshape(-1, 3).sum(1))
+        end = start + int(np.searchsorted(used, limit, side="right"))
+        runs.append(triangles[start:end].reshape(-1))
+        start = end
+    return runs
+
+
+def copy_shape(shape: SOBJShape) -> SOBJShape:
+    """
+    A deep copy of a shape that shares its vertex and index data,
+    which can be memoryviews into the glTF buffers that deepcopy can't copy.
+    """
+    # deepcopy uses whatever the memo already has for an object
+    memo = {}
+    for attribute in shape.vertex_attributes.data.contents:
+        data = getattr(attribute, "vertex_stream_data", None)
+        if data is not None:
+            memo[id(data)] = data
+    for primitive_set in shape.primitive_sets.data.contents:
+        for primitive in primitive_set.primitives.data.contents:
+            for stream in primitive.index_streams.data.contents:
+                memo[id(stream.face_data)] = stream.face_data
+    return copy.deepcopy(shape, memo)
+
+
+def split_shape(shape: SOBJShape, limit: int) -> list[SOBJShape]:
+    """
+    Splits a shape with more vertices than limit into shapes that each fit,
+    one per run of its triangles, with only the vertices that run uses.
+    Returns the shapes replacing it, which is just the shape if it fits.
+    """
+    vertices = shape_vertex_rows(shape)
+    if vertices is None or vertices[1] <= limit:
+        return [shape]
+    count = vertices[1]
+    streams = [
+        stream
+        for primitive_set in shape.primitive_sets.data.contents
+        for primitive in primitive_set.primitives.data.contents
+        for stream in primitive.index_streams.data.contents
+    ]
+    indices = decode_indices(streams[0], count) if len(streams) == 1 else None
+    if indices is None:
+        print(
+            f"WARNING: {shape.name} has more than {limit} vertices and can't be split"
+        )
+        return [shape]
+
+    shapes = []
+    for run in split_triangles(indices, limit):
+        part = copy_shape(shape)
+        used = np.unique(run)
+        primitive = part.primitive_sets.data.contents[0].primitives.data.contents[0]
+        stream = primitive.index_streams.data.contents[0]
+        stream.face_data = np.searchsorted(used, run).astype("<u4").tobytes()
+        stream.data_type = 5125
+        for attribute, size in shape_vertex_rows(part)[0]:
+            data = np.frombuffer(attribute.vertex_stream_data, dtype=np.uint8)
+            attribute.vertex_stream_data = data.reshape(count, size)[used].tobytes()
+        shapes.append(part)
+    return shapes
+
+
+def narrow_index_stream(stream: IndexStream, vertex_count: int) -> bool:
+    """
+    Stores the indices of a stream in the smallest type holding its largest index.
+    Returns whether that's a type the PICA can read.
+    """
+    dtype = INDEX_DTYPES.get(stream.data_type)
+    if dtype is None or len(stream.face_data) % np.dtype(dtype).itemsize:
+        return False
+    indices = np.frombuffer(stream.face_data, dtype=dtype)
+    largest = int(indices.max()) if len(indices) else 0
+    if largest >= vertex_count:
+        return False
+    for data_type, limit in INDEX_LIMITS.items():
+        if largest < limit:
+            stream.face_data = indices.astype(INDEX_DTYPES[data_type]).tobytes()
+            stream.data_type = data_type
+            return True
+    return False
+
+
+def fit_index_streams(cgfx: CGFX, report: ConversionReport | None = None) -> int:
+    """
+    Splits shapes with too many vertices for 16-bit indices, adding a mesh for each
+    new shape right after the mesh it came from, so meshes are drawn in the same
+    order. Meshes after a split one move along, so the visibility animation group
+    gets a member for each added index. Then picks 8 or 16-bit indices for every
+    stream. Returns how many shapes were added.
+    """
+    # shape name -> shapes it was split into
+    split = {}
+    for model_name in cgfx.data.models:
+        cmdl = cgfx.data.models[model_name]
+        shapes = cmdl.shapes.data.contents
+        meshes = []
+        for mesh in cmdl.meshes.data.contents:
+            meshes.append(mesh)
+            parts = split_shape(shapes[mesh.shape_index], INDEX_LIMITS[DataType.UShort])
+            if len(parts) == 1:
+                continue
+            split[shapes[mesh.shape_index].name] = len(parts)
+            shapes[mesh.shape_index] = parts[0]
+            for part in parts[1:]:
+                part_mesh = SOBJMesh(cmdl)
+                part_mesh.name = mesh.name
+                part_mesh.material_index = mesh.material_index
+                part_mesh.is_visible = mesh.is_visible
+                part_mesh.priority = mesh.priority
+                part_mesh.mesh_node_visibility_index = mesh.mesh_node_visibility_index
+                part_mesh.mesh_node_name = mesh.mesh_node_name
+                part_mesh.shape_index = len(cmdl.shapes)
+                cmdl.shapes.add(part)
+                meshes.append(part_mesh)
+        if len(meshes) != len(cmdl.meshes):
+            groups = cmdl.animation_group_descriptions
+            if "VisibilityAnimation" in groups:
+                members = groups["VisibilityAnimation"].members
+                for i in range(len(cmdl.meshes), len(meshes)):
+                    members.add(f"Meshes[{i}].IsVisible", mesh_visibility_member(i))
+            cmdl.meshes.data.contents = meshes
+
+        for shape in shapes:
+            vertices = shape_vertex_rows(shape)
+            for primitive_set in shape.primitive_sets.data.contents:
+                for primitive in primitive_set.primitives.data.contents:
+                    for stream in primitive.index_streams.data.contents:
+                        if vertices is None or not narrow_index_stream(
+                            stream, vertices[1]
+                        ):
+                            print(f"WARNING: {shape.name} has unusable indices")
+    if report is not None:
+        report.split = split
+    return sum(split.values()) - len(split)
+
+
+def optimize_shape(shape: SOBJShape) -> list[tuple[int, float, float]]:
+    """
+    Reorders the triangles of each primitive of the shape for the vertex cache,
+    then renumbers the vertices in the order they're first used so they're read
+    from memory in order. Primitives the new order doesn't improve are kept
+    as they were. Vertices are shared by every primitive of the shape,
+    so nothing is changed unless all of their indices can be read.
+    Returns the triangle count and ACMR before and after of each primitive.
+    """
+    vertices = shape_vertex_rows(shape)
+    if vertices is None:
+        return []
+    rows, count = vertices
+    streams = []
+    for primitive_set in shape.primitive_sets.data.contents:
+        for primitive in primitive_set.primitives.data.contents:
+            for stream in primitive.index_streams.data.contents:
+                indices = decode_indices(stream, count)
+                if indices is None:
+                    return []
+                streams.append((stream, indices))
+    if not streams:
+        return []
+
+    results = []
+    changed = False
+    for i, (stream, indices) in enumerate(streams):
+        before = acmr(indices)
+        ordered = forsyth(indices, count)
+        after = acmr(ordered)
+        if after < before:
+            streams[i] = (stream, ordered)
+            changed = True
+        else:
+            after = before
+        results.append((len(indices) // 3, before, after))
+    if not changed:
+        return results
+    order = first_use_order(np.concatenate([ind for _, ind in streams]), count)
+    remap = np.empty(count, dtype=np.int64)
+    remap[order] = np.arange(count)
+    for stream, indices in streams:
+        dtype = INDEX_DTYPES[stream.data_type]
+        stream.face_data = remap[indices].astype(dtype).tobytes()
+    for attribute, size in rows:
+        data = np.frombuffer(attribute.vertex_stream_data, dtype=np.uint8)
+        attribute.vertex_stream_data = data.reshape(count, size)[order].tobytes()
+    return results
+
+
+def optimize_indices(cgfx: CGFX, report: ConversionReport | None = None) -> int:
+    """optimize_shape on every shape, returning how many primitives were reordered"""
+    # shape name -> (triangles, ACMR before and after) of each primitive,
+    # shapes split by fit_index_streams share a name
+    results = {}
+    for model_name in cgfx.data.models:
+        for shape in cgfx.data.models[model_name].shapes.data.contents:
+            results.setdefault(shape.name, []).extend(optimize_shape(shape))
+    shapes = {}
+    for name, primitives in results.items():
+        triangles = sum(n for n, _, _ in primitives)
+        if triangles:
+            shapes[name] = {
+                "triangles": triangles,
+                "before": sum(n * a for n, a, _ in primitives) / triangles,
+                "after": sum(n * a for n, _, a in primitives) / triangles,
+            }
+    if report is not None:
+        report.indices = {"cache_size": CACHE_SIZE, "shapes": shapes}
+    return sum(
+        after < before
+        for primitives in results.values()
+        for _, before, after in primitives
+    )
+
+
+def stripify_shape(shape: SOBJShape) -> list[tuple[int, int]]:
+    """
+    Turns the triangle list of each primitive of the shape into a strip,
+    keeping whichever has fewer indices.
+    Returns the index count of each primitive before and after.
+    """
+    vertices = shape_vertex_rows(shape)
+    if vertices is None:
+        return []
+    results = []
+    for primitive_set in shape.primitive_sets.data.contents:
+        for primitive in primitive_set.primitives.data.contents:
+            for stream in primitive.index_streams.data.contents:
+                indices = decode_indices(stream, vertices[1])
+                if indices is None or not len(indices):
+                    continue
+                strip = stripify(indices)
+                if len(strip) < len(indices):
+                    dtype = INDEX_DTYPES[stream.data_type]
+                    stream.face_data = strip.astype(dtype).tobytes()
+                    stream.primitive_mode = PrimitiveMode.TriangleStrip
+                    results.append((len(indices), len(strip)))
+                else:
+                    results.append((len(indices), len(indices)))
+    return results
+
+
+def stripify_shapes(cgfx: CGFX, report: ConversionReport | None = None) -> int:
+    """stripify_shape on every shape, returning how many primitives became strips"""
+    strips = lists = 0
+    before = after = 0
+    for model_name in cgfx.data.models:
+        for shape in cgfx.data.models[model_name].shapes.data.contents:
+            for old, new in stripify_shape(shape):
+                if new < old:
+                    strips += 1
+                else:
+                    lists += 1
+                before += old
+                after += new
+    if report is not None:
+        report.strips = {
+            "strips": strips,
+            "lists": lists,
+            "indices_before": before,
+            "indices_after": after,
+        }
+    return strips
+
+
+def reduce_keys(
+    keys: list[StepLinear64Key], interpolation: InterpolationType, tolerance: float
+) -> list[StepLinear64Key]:
+    """drops keys that can be interpolated from their neighbours within tolerance"""
+
+    def close(key, before, after):
+        if interpolation == InterpolationType.Nearest:
+            return abs(key.value - before.value) <= tolerance
+        t = (key.frame - before.frame) / (after.frame - before.frame)
+        expected = before.value + t * (after.value - before.value)
+        return abs(key.value - expected) <= tolerance
+
+    kept = [keys[0]]
+    # keys dropped since the last one that was kept
+    skipped = []
+    for key, after in zip(keys[1:-1], keys[2:]):
+        skipped.append(key)
+        if not all(close(k, kept[-1], after) for k in skipped):
+            kept.append(key)
+            skipped = []
+    kept.append(keys[-1])
+    return kept
+
+
+def reduce_keyframes(cgfx: CGFX, tolerance: float) -> str | None:
+    """tolerance is relative to the range of each curve"""
+    removed = 0
+    for obj in walk(cgfx):
+        if (
+            isinstance(obj, FloatSegment)
+            and obj.single_value is None
+            and obj.quantization == QuantizationType.StepLinear64
+            and len(obj.keys) > 2
+        ):
+            values = [k.value for k in obj.keys]
+            keys = reduce_keys(
+                obj.keys, obj.interpolation, tolerance * (max(values) - min(values))
+            )
+            removed += len(obj.keys) - len(keys)
+            obj.keys = keys
+    if not removed:
+        return None
+    return f"{removed} keys within {tolerance:.1%} of their curve's range"
+
+
+def replace_texture(txob: ImageTexture, new: ImageTexture):
+    # objects referencing the texture stay pointed at it
+    txob.width = txob.pixel_based_image.width = new.width
+    txob.height = txob.pixel_based_image.height = new.height
+    txob.hw_format = new.hw_format
+    txob.mipmap_level_count = new.mipmap_level_count
+    txob.pixel_based_image.data = new.pixel_based_image.data
+
+
+# share of the file below which a kind of data is reduced last
+BUDGET_MIN_SHARE = 0.05
+
+
+def budget_levers(
+    cgfx: CGFX,
+    gltf: gltflib.GLTF,
+    options: ConvertOptions,
+    report: ConversionReport | None,
+):
+    """
+    Applies reductions one at a time, least noticeable first.
+    Within levers that lose about as much quality, whatever takes the most of the
+    file according to size_contributions is reduced first, and anything taking
+    less than BUDGET_MIN_SHARE of it is left until the end.
+    Yields the lever and a description of what it did, or None if it did nothing.
+    """
+    # texture name -> [image, normal]
+    textures = {}
+    for image_id in range(len(gltf.model.images or [])):
+        for normal in (False, True):
+            name = gltf_texture_name(gltf, image_id, normal)
+            if name in cgfx.data.textures:
+                textures[name] = [
+                    gltf_get_texture_image(gltf, image_id, normal),
+                    normal,
+                ]
+
+    def largest_textures():
+        return sorted(
+            textures,
+            key=lambda n: len(cgfx.data.textures[n].pixel_based_image.data),
+            reverse=True,
+        )
+
+    def set_texture(name, im, format):
+        replace_texture(
+            cgfx.data.textures[name],
+            encode_texture(im, format, textures[name][1], options),
+        )
+        textures[name][0] = im
+        if report is not None and name in report.textures:
+            report.textures[name].update(
+                width=im.width, height=im.height, format=format.name
+            )
+
+    def smaller_formats(min_psnr):
+        for name in largest_textures():
+            txob = cgfx.data.textures[name]
+            im, normal = textures[name]
+            analysis = TextureAnalysis(im, min_psnr, normal)
+            if analysis.format.bits_per_pixel() < txob.hw_format.bits_per_pixel():
+                old = txob.hw_format
+                set_texture(name, im, analysis.format)
+                yield "texture format", (
+                    f"{name}: {old.name} -> {analysis.format.name} "
+                    f"({analysis.psnr[analysis.format]:.1f} dB)"
+                )
+
+    def quantize(tolerance):
+        if not quantize_shapes(cgfx, tolerance):
+            return None
+        return f"vertex streams within {tolerance} of the original"
+
+    def halve_textures():
+        while True:
+            # halve the largest texture that still leaves whole tiles
+            for name in largest_textures():
+                im = textures[name][0]
+                if im.width % 16 == 0 and im.height % 16 == 0:
+                    break
+            else:
+                return
+            size = (im.width // 2, im.height // 2)
+            set_texture(
+                name,
+                im.resize(size, Image.Resampling.LANCZOS),
+                cgfx.data.textures[name].hw_format,
+            )
+            yield "texture resolution", (
+                f"{name}: {im.width}x{im.height} -> {size[0]}x{size[1]}"
+            )
+
+    # levers with about the same loss of quality, by what they reduce
+    rounds = [
+        {
+            "vertex streams": lambda: [("vertex quantization", quantize(0.001))],
+            "animation curves": lambda: [
+                ("keyframe reduction", reduce_keyframes(cgfx, 0.001))
+            ],
+            "textures": lambda: smaller_formats(30.0),
+        },
+        {
+            "vertex streams": lambda: [("vertex quantization", quantize(0.005))],
+            "animation curves": lambda: [
+                ("keyframe reduction", reduce_keyframes(cgfx, 0.01))
+            ],
+            "textures": lambda: smaller_formats(25.0),
+        },
+        {
+            "vertex streams": lambda: [("vertex quantization", quantize(0.02))],
+            "animation curves": lambda: [
+                ("keyframe reduction", reduce_keyframes(cgfx, 0.05))
+            ],
+            "textures": halve_textures,
+        },
+    ]
+    skipped = []
+    for levers in rounds:
+        total = estimate_size(cgfx)["total"]
+        contributions = size_contributions(cgfx)
+        for kind in sorted(levers, key=lambda k: -contributions[k]):
+            if contributions[kind] < BUDGET_MIN_SHARE * total:
+                skipped.append(levers[kind])
+                continue
+            yield from levers[kind]()
+    # small contributors are only reduced once nothing else is left
+    for lever in skipped:
+        yield from lever()
+
+
+def fit_budget(
+    cgfx: CGFX,
+    gltf: gltflib.GLTF,
+    options: ConvertOptions | None = None,
+    report: ConversionReport | None = None,
+    budget: int = MAX_SIZE,
+) -> int:
+    """
+    Makes a converted file fit in budget bytes by lowering its quality as little as
+    possible. Sizes come from the layout pass alone. Returns the final size.
+    """
+    if options is None:
+        options = ConvertOptions()
+    size = initial_size = estimate_size(cgfx)["total"]
+    contributions = size_contributions(cgfx)
+    levers = []
+    if size > budget:
+        for lever, detail in budget_levers(cgfx, gltf, options, report):
+            if detail is None:
+                continue
+            new_size = estimate_size(cgfx)["total"]
+            levers.append({"lever": lever, "detail": detail, "saved": size - new_size})
+            size = new_size
+            if size <= budget:
+                break
+        else:
+            print(f"WARNING: could only reduce the CGFX to {size} bytes")
+    if report is not None:
+        report.budget = {
+            "budget": budget,
+            "initial_size": initial_size,
+            "final_size": size,
+            "contributions": contributions,
+            "levers": levers,
+        }
+    return size
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert a glTF model to CGFX.")
-    parser.add_argument("in_gltf", type=str, help="The input glTF (.gltf or .glb)")
+    parser.add_argument(
+        "in_gltf",
+        type=str,
+        help="The input glTF (.gltf or .glb), or a CGFX with --size-report",
+    )
     parser.add_argument(
         "out_cgfx", type=str, help="The output CGFX (.cgfx)", nargs="?", default=None
     )
+    parser.add_argument(
+        "--texture-format",
+        choices=[f.name for f in swizzler.supported_formats()] + ["auto"],
+        default=ConvertOptions.texture_format.name,
+        help="The format textures are stored in, or auto to pick the smallest one "
+        "that looks good enough for each (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--min-psnr",
+        type=float,
+        default=ConvertOptions.min_psnr,
+        help="The lowest PSNR in dB allowed by --texture-format auto "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Keep encoded textures in this directory, "
+        "so unchanged textures aren't encoded again",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Size limit of the texture cache in MB, "
+        "least recently used textures are removed first",
+    )
+    parser.add_argument(
+        "--atlas",
+        action="store_true",
+        help="Pack small textures that aren't repeated onto shared textures",
+    )
+    parser.add_argument(
+        "--quantize-vertices",
+        type=float,
+        nargs="?",
+        const=0.005,
+        default=None,
+        metavar="TOLERANCE",
+        help="Store vertex data in the smallest types that keep it within "
+        "TOLERANCE of the original (default: %(const)s)",
+    )
+    parser.add_argument(
+        "--interleave",
+        action="store_true",
+        help="Store the vertex attributes of each mesh in one buffer",
+    )
+    parser.add_argument(
+        "--optimize-indices",
+        action="store_true",
+        help="Reorder triangles and vertices to make better use of the vertex cache",
+    )
+    parser.add_argument(
+        "--strips",
+        action="store_true",
+        help="Draw meshes with triangle strips when they're smaller than lists",
+    )
+    parser.add_argument(
+        "--budget",
+        type=lambda x: int(x, 0),
+        nargs="?",
+        const=MAX_SIZE,
+        default=None,
+        help="Lower the quality until the file fits in this many bytes "
+        f"(default: {MAX_SIZE:#x})",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the size the file would have instead of writing it",
+    )
+    parser.add_argument(
+        "--size-report",
+        choices=["table", "json"],
+        nargs="?",
+        const="table",
+        default=None,
+        help="Print the size of each object in the output, "
+        "or in the input if it's already a CGFX",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Print the choices made during conversion",
+    )
+    parser.add_argument(
+        "--etc1-quality",
+        choices=[q.name for q in ETC1Quality],
+        default=ConvertOptions.etc1_quality.name,
+        help="How hard to search for ETC1 block colours (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes used for encoding textures (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--diffuse-mipmaps",
+        type=int,
+        default=ConvertOptions.diffuse_mipmaps,
+        help="Mipmap levels for diffuse textures, 0 for all (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--normal-mipmaps",
+        type=int,
+        default=ConvertOptions.normal_mipmaps,
+        help="Mipmap levels for normal textures, 0 for all (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--renormalize-normals",
+        action="store_true",
+        help="Rescale normal map texels to unit length after filtering",
+    )
+    parser.add_argument(
+        "--mipmap-filter",
+        choices=[f.name for f in MipmapFilter],
+        default=ConvertOptions.mipmap_filter.name,
+        help="How mipmaps are downsampled (default: %(default)s)",
+    )
     args = parser.parse_args()
+    options = ConvertOptions()
+    if args.texture_format == "auto":
+        options.texture_format = None
+    else:
+        options.texture_format = TextureFormat[args.texture_format]
+    options.min_psnr = args.min_psnr
+    options.etc1_quality = ETC1Quality[args.etc1_quality]
+    options.workers = args.workers
+    options.diffuse_mipmaps = args.diffuse_mipmaps
+    options.normal_mipmaps = args.normal_mipmaps
+    options.mipmap_filter = MipmapFilter[args.mipmap_filter]
+    options.renormalize_normals = args.renormalize_normals
+    options.cache_dir = args.cache_dir
+    options.cache_size = args.cache_size << 20
+    options.atlas = args.atlas
+    options.vertex_tolerance = args.quantize_vertices
+    options.interleave = args.interleave
+    options.optimize_indices = args.optimize_indices
+    options.strips = args.strips
     if args.out_cgfx is None:
         args.out_cgfx = os.path.splitext(args.in_gltf)[0] + ".cgfx"
 
-    gltf = gltflib.GLTF.load(args.in_gltf, load_file_resources=True)
-    cgfx = convert_gltf(gltf)
-    with open(args.out_cgfx, "wb") as f:
-        f.write(write(cgfx))
+    if os.path.splitext(args.in_gltf)[1].lower() in (".cgfx", ".bcres"):
+        with open(args.in_gltf, "rb") as f:
+            breakdown = sizes.attribute_file(f.read())
+        print(
+            breakdown.to_json()
+            if args.size_report == "json"
+            else breakdown.format_table()
+        )
+        return
+
+    gltf = gltflib.GLTF.load(args.in_gltf)
+    map_file_resources(gltf, os.path.dirname(args.in_gltf))
+    report = ConversionReport()
+    cgfx = convert_gltf(gltf, options, report)
+    if args.budget is not None:
+        fit_budget(cgfx, gltf, options, report, args.budget)
+    if args.dry_run:
+        for part, size in estimate_size(cgfx).items():
+            print(f"{part:<8} {size:>8}")
+    else:
+        with open(args.out_cgfx, "wb") as f:
+            write_to(cgfx, f)
+    if args.report or args.budget is not None:
+        print(report.format_table())
+    if args.size_report:
+        breakdown = size_report(cgfx)
+        print(
+            breakdown.to_json()
+            if args.size_report == "json"
+            else breakdown.format_table()
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import numpy as np
+import main
+from cgfx.primitives import (
+    DataType,
+    IndexStream,
+    Primitive,
+    PrimitiveSet,
+    VertexAttributeUsage,
+    VertexStream,
+)
+from cgfx.cgfx import CGFX
+from cgfx.cmdl import CMDL
+from cgfx.sobj import SOBJMesh, SOBJShape
+
+
+def grid_shape(width: int, height: int) -> SOBJShape:
+    """a grid of triangles whose data are views into one buffer, like a glTF's"""
+    ys, xs = np.mgrid[0 : height + 1, 0 : width + 1]
+    positions = np.stack((xs, ys, xs * ys), -1).reshape(-1, 3).astype("<f4")
+    g = np.arange(len(positions)).reshape(height + 1, width + 1)
+    a, b, c, d = g[:-1, :-1], g[:-1, 1:], g[1:, :-1], g[1:, 1:]
+    indices = np.stack((np.stack((a, b, c), -1), np.stack((b, d, c), -1)), 2)
+    indices = indices.reshape(-1).astype("<u4")
+    buffer = memoryview(positions.tobytes() + indices.tobytes())
+
+    shape = SOBJShape()
+    shape.name = "grid"
+    vs = VertexStream()
+    vs.usage = VertexAttributeUsage.Position
+    vs.components_count = 3
+    vs.format_type = DataType.Float
+    vs.vertex_stream_data = buffer[: positions.nbytes]
+    shape.vertex_attributes.add(vs)
+    primitive_set = PrimitiveSet()
+    shape.primitive_sets.add(primitive_set)
+    primitive = Primitive()
+    primitive_set.primitives.add(primitive)
+    stream = IndexStream()
+    stream.data_type = 5125
+    stream.face_data = buffer[positions.nbytes :]
+    primitive.index_streams.add(stream)
+    return shape
+
+
+def triangles(shape: SOBJShape) -> list:
+    """the positions of each triangle of a shape"""
+    stream = shape.primitive_sets.data.contents[0].primitives.data.contents[0]
+    stream = stream.index_streams.data.contents[0]
+    indices = np.frombuffer(stream.face_data, dtype=main.INDEX_DTYPES[stream.data_type])
+    vs = shape.vertex_attributes.data.contents[0]
+    positions = np.frombuffer(vs.vertex_stream_data, dtype="<f4").reshape(-1, 3)
+    return positions[indices].reshape(-1, 9).tolist()
+
+
+def test_split_shape():
+    shape = grid_shape(20, 20)
+    expected = triangles(shape)
+    parts = main.split_shape(shape, 100)
+    assert len(parts) > 1
+    for part in parts:
+        assert main.shape_vertex_rows(part)[1] <= 100
+    assert [t for part in parts for t in triangles(part)] == expected
+
+
+def test_split_shape_fits():
+    shape = grid_shape(4, 4)
+    assert main.split_shape(shape, 100) == [shape]
+
+
+def test_narrow_index_stream():
+    shape = grid_shape(20, 20)
+    expected = triangles(shape)
+    stream = shape.primitive_sets.data.contents[0].primitives.data.contents[0]
+    stream = stream.index_streams.data.contents[0]
+    assert main.narrow_index_stream(stream, 21 * 21)
+    assert stream.data_type == DataType.UShort
+    assert triangles(shape) == expected
+    for part in main.split_shape(shape, 200):
+        stream = part.primitive_sets.data.contents[0].primitives.data.contents[0]
+        stream = stream.index_streams.data.contents[0]
+        assert main.narrow_index_stream(stream, main.shape_vertex_rows(part)[1])
+        assert stream.data_type == DataType.UByte
+
+
+def test_fit_index_streams_keeps_mesh_order():
+    cgfx = CGFX()
+    cmdl = CMDL()
+    cgfx.data.models.add("model", cmdl)
+    for name, size in (("first", 4), ("big", 300), ("last", 4)):
+        shape = grid_shape(size, size)
+        shape.name = name
+        mesh = SOBJMesh(cmdl)
+        mesh.name = name
+        mesh.shape_index = len(cmdl.shapes)
+        cmdl.shapes.add(shape)
+        cmdl.meshes.add(mesh)
+    assert main.fit_index_streams(cgfx) == 1
+    meshes = cmdl.meshes.data.contents
+    assert [mesh.name for mesh in meshes] == ["first", "big", "big", "last"]
+    for mesh in meshes:
+        shape = cmdl.shapes.data.contents[mesh.shape_index]
+        assert shape.name == mesh.name
+        assert main.shape_vertex_rows(shape)[1] <= 0x10000